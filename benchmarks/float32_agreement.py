@@ -0,0 +1,79 @@
+"""
+Checks that --dtype float32 gives the same decomposition as the default
+(float64) within a tolerance: the input is loaded, normalized and fit by
+PCA in both precisions, and the leading components and scores are
+compared (up to sign, which is arbitrary). Exits non-zero if they differ
+by more than --tolerance relative to the largest value:
+
+    python benchmarks/float32_agreement.py -i examples/data/counts.txt -f -rpkm -l2
+"""
+import sys
+
+from argparse import ArgumentParser
+
+import numpy as np
+
+from decomposition import Experiment
+
+
+def fit(counts_file, dtype, is_featurecounts, rpkm, log2, n_components):
+    """
+    Returns the PCA loadings and scores of counts_file normalized and fit
+    in dtype (as the decompose command line would with --dtype).
+
+    Returns
+    -------
+    components : numpy.ndarray
+        (components, features) float64
+    scores : numpy.ndarray
+        (samples, components) float64
+    """
+    expt = Experiment.Experiment(
+        counts_file, is_featurecounts=is_featurecounts, dtype=dtype,
+        lazy=True
+    )
+    expt.counts.normalize(rpkm=rpkm, log2=log2, pseudocount=1)
+    pca, prcomp = expt.pca()
+    return (
+        np.asarray(pca.components_[:n_components], dtype=np.float64),
+        np.asarray(prcomp.values[:, :n_components], dtype=np.float64)
+    )
+
+
+def relative_error(a, b):
+    """ max absolute difference of |a| and |b|, relative to max |a| """
+    a = np.abs(a)
+    return np.abs(a - np.abs(b)).max() / a.max()
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument("-i", "--input", default='examples/data/counts.txt')
+    parser.add_argument("-f", "--featureCounts", action='store_true')
+    parser.add_argument("-rpkm", "--rpkm", action='store_true')
+    parser.add_argument("-l2", "--log2", action='store_true')
+    parser.add_argument("-n", "--n-components", type=int, default=2,
+                        help="leading components compared [2]")
+    parser.add_argument("--tolerance", type=float, default=1e-4,
+                        help="largest relative difference allowed [1e-4]")
+    args = parser.parse_args()
+
+    results = [
+        fit(args.input, dtype, args.featureCounts, args.rpkm, args.log2,
+            args.n_components)
+        for dtype in ('float64', 'float32')
+    ]
+    failed = False
+    for name, i in (('components', 0), ('scores', 1)):
+        error = relative_error(results[0][i], results[1][i])
+        print("{}: max relative difference {:.2e}".format(name, error))
+        if error > args.tolerance:
+            print("FAIL: {} differ by more than {}".format(
+                name, args.tolerance
+            ))
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,381 @@
+"""
+Times the decomposition pipeline on synthetic matrices: Experiment
+construction, each ExpressionTable transform, the pcaplot/icaplot/tsneplot
+fits and the color_helpers conversions, for every combination of --kinds,
+--genes and --samples. Results are written as JSON; given a --baseline
+from an earlier version, stages that got slower than --tolerance are
+reported and the exit status is non-zero:
+
+    python benchmarks/pipeline.py --genes 20000 --samples 1000 10000 \\
+        --output results.json --baseline previous.json
+"""
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+import matplotlib
+
+matplotlib.use('Agg')
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from decomposition import color_helpers as ch
+from decomposition import Experiment
+from decomposition import stage_timer
+
+# dense text table, memory-mapped .npy, featureCounts counts.txt and a
+# scipy .npz (10x-like) matrix with gene/barcode names.
+KINDS = ('bulk', 'npy', 'featurecounts', 'sparse')
+ALGORITHMS = ('PCA', 'ICA', 'TSNE')
+# cells generated (and written) at a time.
+GENERATE_CELLS = 5000000
+# genes with a group effect in each sample group.
+GROUPS = 5
+GROUP_GENES = 0.05
+# genes recolored through the color index.
+MARKERS = 100
+
+
+def synthetic_chunks(n_genes, n_samples, single_cell=False, seed=0):
+    """
+    Yields (genes, samples) Poisson counts a block of genes at a time.
+    Samples belong to one of GROUPS groups, each raising GROUP_GENES of
+    the genes 4-fold, so the embeddings have structure to find.
+    single_cell uses low means, so most counts are zero.
+
+    Parameters
+    ----------
+    n_genes : int
+    n_samples : int
+    single_cell : bool
+    seed : int
+
+    Returns
+    -------
+    generator of numpy.ndarray of int32
+    """
+    rng = np.random.RandomState(seed)
+    groups = rng.randint(GROUPS, size=n_samples)
+    size_factors = rng.lognormal(0, 0.3, size=n_samples)
+    block = max(1, GENERATE_CELLS // n_samples)
+    for start in range(0, n_genes, block):
+        n = min(block, n_genes - start)
+        if single_cell:
+            means = rng.lognormal(-1.5, 1.5, size=n)
+        else:
+            means = rng.lognormal(3, 2, size=n)
+        effects = np.where(
+            rng.rand(n, GROUPS) < GROUP_GENES, 4.0, 1.0
+        )
+        lam = means[:, np.newaxis] * effects[:, groups] * size_factors
+        yield rng.poisson(lam).astype(np.int32)
+
+
+def gene_names(n):
+    return ['gene{}'.format(i) for i in range(n)]
+
+
+def sample_names(n):
+    return ['sample{}'.format(i) for i in range(n)]
+
+
+def write_dataset(kind, n_genes, n_samples, directory):
+    """
+    Writes a synthetic matrix of the given kind into directory.
+
+    Returns
+    -------
+    dict
+        Experiment keyword arguments to load it
+    """
+    genes = gene_names(n_genes)
+    samples = sample_names(n_samples)
+    chunks = synthetic_chunks(n_genes, n_samples, kind == 'sparse')
+    path = os.path.join(directory, 'counts')
+
+    if kind == 'sparse':
+        path += '.npz'
+        sparse.save_npz(path, sparse.vstack(
+            [sparse.csr_matrix(chunk) for chunk in chunks], format='csr'
+        ))
+        return dict(
+            counts_file=path,
+            row_names_file=_write_names(directory, 'genes.tsv', genes),
+            col_names_file=_write_names(directory, 'barcodes.tsv', samples),
+        )
+    if kind == 'npy':
+        path += '.npy'
+        values = np.lib.format.open_memmap(
+            path, mode='w+', dtype=np.int32, shape=(n_genes, n_samples)
+        )
+        start = 0
+        for chunk in chunks:
+            values[start:start + len(chunk)] = chunk
+            start += len(chunk)
+        values.flush()
+        del values
+        return dict(
+            counts_file=path,
+            row_names_file=_write_names(directory, 'rows.txt', genes),
+            col_names_file=_write_names(directory, 'cols.txt', samples),
+        )
+
+    path += '.txt'
+    rng = np.random.RandomState(1)
+    start = 0
+    with open(path, 'w') as f:
+        if kind == 'featurecounts':
+            f.write('# Program:featureCounts (synthetic)\n')
+            header = ['Geneid', 'Chr', 'Start', 'End', 'Strand', 'Length']
+        else:
+            header = ['gene']
+        f.write('\t'.join(header + samples) + '\n')
+        for chunk in chunks:
+            data = pd.DataFrame(
+                chunk, index=genes[start:start + len(chunk)], columns=samples
+            )
+            if kind == 'featurecounts':
+                length = rng.randint(500, 10000, size=len(chunk))
+                begin = np.arange(start, start + len(chunk)) * 20000 + 1
+                annotation = pd.DataFrame(
+                    dict(Chr='chr1', Start=begin, End=begin + length - 1,
+                         Strand='+', Length=length),
+                    index=data.index,
+                    columns=header[1:]
+                )
+                data = pd.concat([annotation, data], axis=1)
+            data.to_csv(f, sep='\t', header=False)
+            start += len(chunk)
+    return dict(counts_file=path, is_featurecounts=kind == 'featurecounts')
+
+
+def _write_names(directory, name, names):
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        f.write('\n'.join(names) + '\n')
+    return path
+
+
+def run_pipeline(kind, load_args, directory, algorithms, timer):
+    """
+    Runs and times each step of the pipeline on one dataset.
+
+    Parameters
+    ----------
+    kind : basestring
+    load_args : dict
+        @see write_dataset()
+    directory : basestring
+        scratch directory (for the subset file)
+    algorithms : list
+    timer : stage_timer.StageTimer
+    """
+    import matplotlib.pyplot as plt
+    from decomposition import ICAPlotter
+    from decomposition import PCAPlotter
+    from decomposition import TSNEPlotter
+
+    with timer.stage('experiment'):
+        expt = Experiment.Experiment(cache_dir=None, **load_args)
+    counts = expt.counts
+
+    subset_file = os.path.join(directory, 'subset.txt')
+    rng = np.random.RandomState(2)
+    genes = counts.index[rng.rand(counts.shape[0]) < 0.8]
+    _write_names(directory, 'subset.txt', [str(g) for g in genes])
+    with timer.stage('subset'):
+        counts.subset(subset_file)
+    if kind == 'featurecounts':
+        with timer.stage('rpkm'):
+            counts.as_rpkm()
+    with timer.stage('cutoff'):
+        counts.min_row_sum_cutoff(1)
+    with timer.stage('log2'):
+        counts.as_log2(1)
+    with timer.stage('top_variable'):
+        counts.top_variable(min(2000, counts.shape[0]))
+
+    # keep one-off imports out of the first fit's time
+    import sklearn.decomposition
+    import sklearn.manifold
+
+    expt.recolor(counts.index[0])
+    plots = dict(
+        PCA=PCAPlotter.pcaplot,
+        ICA=ICAPlotter.icaplot,
+        TSNE=TSNEPlotter.tsneplot
+    )
+    # ICA and t-SNE start from the PCA fit, which is shared (and timed
+    # under PCA) when PCA runs first.
+    for algorithm in algorithms:
+        fig, ax = plt.subplots()
+        with timer.stage(algorithm.lower() + 'plot'):
+            plots[algorithm](expt, 'Purples', ax=ax)
+        plt.close(fig)
+
+    cmap = plt.get_cmap('Purples')
+    colors = expt.metadata['color']
+    with timer.stage('expr_series_to_hex'):
+        ch.expr_series_to_hex(colors, cmap)
+    with timer.stage('expr_series_to_codes'):
+        ch.expr_series_to_codes(colors)
+    markers = counts.index[:MARKERS]
+    with timer.stage('gene color index'):
+        index = expt.index_gene_colors(list(markers))
+    with timer.stage('indexed recolor x{}'.format(len(markers))):
+        for gene in markers:
+            index.to_hex(gene, cmap)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the stages whose wall time grew more than tolerance-fold over
+    the same stage (same dataset) in baseline.
+
+    Returns
+    -------
+    list of basestring
+    """
+    before = {}
+    for run in baseline['runs']:
+        for stage in run['stages']:
+            before[run['dataset'], stage['stage']] = stage['wall_seconds']
+    regressions = []
+    for run in results['runs']:
+        for stage in run['stages']:
+            key = (run['dataset'], stage['stage'])
+            # ignore stages too short to time reliably
+            if key in before and stage['wall_seconds'] > 0.05 and \
+                    stage['wall_seconds'] > before[key] * tolerance:
+                regressions.append("{} {}: {:.3f}s (was {:.3f}s)".format(
+                    key[0], key[1], stage['wall_seconds'], before[key]
+                ))
+    return regressions
+
+
+def best_of(runs):
+    """ per stage, the repeat with the lowest wall time """
+    best = {}
+    order = []
+    for stages in runs:
+        for stage in stages:
+            name = stage['stage']
+            if name not in best:
+                order.append(name)
+                best[name] = stage
+            elif stage['wall_seconds'] < best[name]['wall_seconds']:
+                best[name] = stage
+    return [best[name] for name in order]
+
+
+def version():
+    """ git commit of the checkout being benchmarked, if any """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument("--kinds", nargs='+', default=list(KINDS),
+                        choices=KINDS)
+    parser.add_argument("--genes", nargs='+', type=int, default=[2000])
+    parser.add_argument("--samples", nargs='+', type=int, default=[500])
+    parser.add_argument("--algorithms", default='PCA,ICA,TSNE',
+                        help="comma-separated plots to time [PCA,ICA,TSNE]")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="runs per dataset, the fastest is kept")
+    parser.add_argument("--output", default='benchmark.json')
+    parser.add_argument("--baseline", default=None,
+                        help="earlier --output to compare against")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="fail on stages slower than this times the "
+                             "baseline [1.25]")
+    parser.add_argument("--workdir", default=None,
+                        help="where synthetic data is written (a "
+                             "temporary directory, removed afterwards, "
+                             "if not set)")
+    args = parser.parse_args()
+
+    algorithms = [a.strip().upper() for a in args.algorithms.split(',')]
+    for algorithm in algorithms:
+        if algorithm not in ALGORITHMS:
+            parser.error("unknown algorithm: {}".format(algorithm))
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='decompose-bench')
+    results = dict(
+        version=version(),
+        date=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        pandas=pd.__version__,
+        platform=platform.platform(),
+        runs=[],
+    )
+    try:
+        for kind in args.kinds:
+            for n_genes in args.genes:
+                for n_samples in args.samples:
+                    dataset = '{}/{}x{}'.format(kind, n_genes, n_samples)
+                    directory = os.path.join(
+                        workdir, '{}_{}x{}'.format(kind, n_genes, n_samples)
+                    )
+                    if not os.path.isdir(directory):
+                        os.makedirs(directory)
+                    start = time.time()
+                    load_args = write_dataset(
+                        kind, n_genes, n_samples, directory
+                    )
+                    print("{}: generated in {:.1f}s".format(
+                        dataset, time.time() - start
+                    ))
+                    runs = []
+                    for _ in range(args.repeat):
+                        timer = stage_timer.StageTimer()
+                        run_pipeline(
+                            kind, load_args, directory, algorithms, timer
+                        )
+                        runs.append(timer.stages)
+                    stages = best_of(runs)
+                    for stage in stages:
+                        print("  {:<24} {:>9.3f}s wall {:>9.3f}s cpu".format(
+                            stage['stage'], stage['wall_seconds'],
+                            stage['cpu_seconds']
+                        ))
+                    results['runs'].append(dict(
+                        dataset=dataset, kind=kind, genes=n_genes,
+                        samples=n_samples, stages=stages
+                    ))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("results written to {}".format(args.output))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: {}".format(regression))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
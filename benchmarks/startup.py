@@ -0,0 +1,103 @@
+"""
+Times how long the decompose command line takes to start, and checks that
+the plotting and estimator libraries are not imported before a run needs
+them. Exits non-zero on a regression, so it can run alongside the other
+benchmarks:
+
+    python benchmarks/startup.py --repeat 5 --max-seconds 2.0
+"""
+import subprocess
+import sys
+import time
+
+from argparse import ArgumentParser
+
+# only imported once a plot is actually made
+DEFERRED_MODULES = ('matplotlib.pyplot', 'sklearn', 'seaborn', 'bokeh')
+
+HELP = (
+    "import sys\n"
+    "from decomposition import decompose\n"
+    "sys.argv = ['decompose', '--help']\n"
+    "try:\n"
+    "    decompose.main()\n"
+    "except SystemExit:\n"
+    "    pass\n"
+)
+
+IMPORTED = (
+    "import sys\n"
+    "from decomposition import decompose\n"
+    "print(' '.join(sorted(set(\n"
+    "    deferred for name in sys.modules\n"
+    "    for deferred in {!r}\n"
+    "    if name == deferred or name.startswith(deferred + '.')\n"
+    "))))\n"
+).format(DEFERRED_MODULES)
+
+
+def time_help(repeat):
+    """
+    Returns the wall time (seconds) of each of repeat `decompose --help`
+    runs, each in a fresh interpreter.
+
+    Parameters
+    ----------
+    repeat : int
+
+    Returns
+    -------
+    list of float
+    """
+    times = []
+    with open(subprocess.os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.check_call(
+                [sys.executable, '-c', HELP], stdout=devnull
+            )
+            times.append(time.time() - start)
+    return times
+
+
+def imported_at_startup():
+    """
+    Returns the deferred modules that importing decompose pulls in.
+
+    Returns
+    -------
+    list of basestring
+    """
+    output = subprocess.check_output([sys.executable, '-c', IMPORTED])
+    return output.decode('utf-8').split()
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=2.0,
+                        help="fail if the median --help time exceeds this")
+    args = parser.parse_args()
+
+    times = sorted(time_help(args.repeat))
+    median = times[len(times) // 2]
+    print("decompose --help: median {:.3f}s, min {:.3f}s, max {:.3f}s".format(
+        median, times[0], times[-1]
+    ))
+    imported = imported_at_startup()
+    print("deferred modules imported at startup: {}".format(
+        ', '.join(imported) or 'none'
+    ))
+
+    failed = False
+    if median > args.max_seconds:
+        print("FAIL: startup slower than {}s".format(args.max_seconds))
+        failed = True
+    if imported:
+        print("FAIL: {} imported at startup".format(', '.join(imported)))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,8 +3,73 @@ import numpy as np
 import pandas as pd
 
 import color_helpers as ch
+import component_helpers as cph
 from ExpressionTable import ExpressionTable
 from ExpressionTable import FeatureCountsTable
+from ExpressionTable import MappedExpressionTable
+from ExpressionTable import SparseExpressionTable
+from ExpressionTable import is_sparse_file
+from ExpressionTable import is_npy_file
+
+
+def load_counts(counts_file, is_featurecounts=False, row_names_file=None,
+                col_names_file=None, cache_dir=None, chunksize=None,
+                dtype=None, lazy=False, mmap=False, mmap_dir=None,
+                lengths_file=None):
+    """
+    Returns the table class matching counts_file (featureCounts output,
+    a sparse matrix, a memory-mapped .npy matrix or a dense text table).
+
+    Parameters
+    ----------
+    counts_file : basestring
+    is_featurecounts : bool
+    row_names_file : basestring
+        gene names for sparse and .npy input
+    col_names_file : basestring
+        sample names for sparse and .npy input
+    cache_dir : basestring
+    chunksize : int
+    dtype : numpy.dtype
+    lazy : bool
+    mmap : bool
+        memory-map the values from the cache (dense tables only)
+    mmap_dir : basestring
+        write transformed values to memory-mapped files in this directory
+        (dense tables only)
+    lengths_file : basestring
+        gene lengths for RPKM of sparse input (featureCounts tables carry
+        their own)
+
+    Returns
+    -------
+    ExpressionTable.ExpressionTable
+    """
+    if is_featurecounts:
+        return FeatureCountsTable(
+            counts_file, cache_dir=cache_dir, chunksize=chunksize,
+            dtype=np.int32 if dtype is None else dtype,
+            lazy=lazy, mmap=mmap, mmap_dir=mmap_dir
+        )
+    elif is_sparse_file(counts_file):
+        return SparseExpressionTable(
+            counts_file,
+            row_names_file=row_names_file,
+            col_names_file=col_names_file,
+            lengths_file=lengths_file,
+            dtype=dtype
+        )
+    elif is_npy_file(counts_file):
+        return MappedExpressionTable(
+            counts_file,
+            row_names_file=row_names_file,
+            col_names_file=col_names_file,
+            dtype=dtype, lazy=lazy, mmap_dir=mmap_dir
+        )
+    return ExpressionTable(
+        counts_file, cache_dir=cache_dir, dtype=dtype, lazy=lazy, mmap=mmap,
+        mmap_dir=mmap_dir
+    )
 
 
 class Experiment():
@@ -17,12 +82,28 @@ class Experiment():
     while the metadata(iris.names) describes each sample name.
     """
     def __init__(self, counts_file, conditions_file=None, conditions_col=None,
-                 gene_id=None, is_featurecounts=False):
+                 gene_id=None, is_featurecounts=False,
+                 row_names_file=None, col_names_file=None, cache_dir=None,
+                 chunksize=None, dtype=None, lazy=False, mmap=False,
+                 mmap_dir=None, counts=None, lengths_file=None):
 
-        if is_featurecounts:
-            self.counts = FeatureCountsTable(counts_file)
-        else:
-            self.counts = ExpressionTable(counts_file)
+        if counts is None:
+            counts = load_counts(
+                counts_file,
+                is_featurecounts=is_featurecounts,
+                row_names_file=row_names_file,
+                col_names_file=col_names_file,
+                cache_dir=cache_dir,
+                chunksize=chunksize,
+                dtype=dtype,
+                lazy=lazy,
+                mmap=mmap,
+                mmap_dir=mmap_dir,
+                lengths_file=lengths_file
+            )
+        self.counts = counts
+        self._pca = {}
+        self._color_index = None
 
         self.source = conditions_file
         self.gene_of_interest = gene_id
@@ -34,6 +115,44 @@ class Experiment():
             gene_id,
         )
 
+    def pca(self, n_components=None, svd_solver=None, batch_size=None):
+        """
+        Returns a PCA of the (normalized) counts. Fits are kept per set of
+        parameters until the counts change, so the PCA plot, ICA whitening
+        and t-SNE input all share one SVD of the same matrix.
+
+        Parameters
+        ----------
+        n_components : int
+        svd_solver : basestring
+            @see component_helpers.pca_params()
+        batch_size : int
+            samples per batch of the 'incremental' solver
+            @see component_helpers.fit_incremental_pca()
+
+        Returns
+        -------
+        smusher : sklearn.decomposition.PCA or TruncatedSVD
+        prcomp : pandas.DataFrame
+            table of (samples, components) scores
+        """
+        counts = self.counts
+        counts.data  # run any pending operations first
+        n_components, svd_solver = cph.pca_params(
+            counts.shape, counts.is_sparse, n_components, svd_solver
+        )
+        version = (id(counts), counts.version)
+        key = version + (n_components, svd_solver, batch_size)
+        if key not in self._pca:
+            # drop fits of an earlier version of the counts
+            self._pca = dict(
+                (k, fit) for k, fit in self._pca.items() if k[:2] == version
+            )
+            self._pca[key] = cph.fit_pca(
+                counts, n_components, svd_solver, batch_size
+            )
+        return self._pca[key]
+
     def set_metadata(self, conditions_file, conditions_col, gene_id):
         """
         Generates metadata for gene expression. First checks for a
@@ -55,7 +174,11 @@ class Experiment():
         if conditions_file is not None and conditions_col is not None:
             return self._generate_metadata_from_conditions()
         elif gene_id is not None:
-            return self._generate_metadata_from_gene_expression()
+            # the row as read, without loading a lazy table (@see
+            # ExpressionTable.raw_row())
+            return self._metadata_from_expression(
+                self.counts.raw_row(gene_id)
+            )
         else:
             return self._generate_metadata_from_nothing()
 
@@ -72,7 +195,7 @@ class Experiment():
 
         """
         colors = {}
-        for col in self.counts.data.columns:
+        for col in self.counts.columns:
             colors[col] = {'color': 'blue', 'condition': 'condition'}
         return pd.DataFrame(colors).T
 
@@ -107,10 +230,29 @@ class Experiment():
         -------
         pandas.DataFrame containing samples, color, condition information.
 
+        """
+        expr = None
+        if self.gene_of_interest in self.counts.index:
+            expr = self.counts.row(self.gene_of_interest)
+        return self._metadata_from_expression(expr)
+
+    def _metadata_from_expression(self, expr):
+        """
+        Colors samples by the (LOG2) level of expr, or returns generic
+        metadata if expr is None (the gene is not in the table).
+
+        Parameters
+        ----------
+        expr : pandas.Series
+            expression of the gene of interest in each sample
+
+        Returns
+        -------
+        pandas.DataFrame containing samples, color, condition information.
+
         """
         colors = {}
-        if self.gene_of_interest in self.counts.data.index:
-            expr = self.counts.data.loc[self.gene_of_interest]
+        if expr is not None:
             expr = np.log2(expr+1)
             for key, value in expr.iteritems():
                 colors[key] = {'color': value,
@@ -124,3 +266,50 @@ class Experiment():
     def recolor(self, gene_id):
         self.gene_of_interest = gene_id
         self.metadata = self._generate_metadata_from_gene_expression()
+
+    def index_gene_colors(self, genes):
+        """
+        Precomputes the expression colors of a list of (marker) genes, so
+        plotters can recolor by any of them without rebuilding the metadata.
+        The index is dropped once the counts change.
+        @see color_helpers.GeneColorIndex
+
+        Parameters
+        ----------
+        genes : list or basestring
+            gene ids, or a line-delimited file of gene ids
+
+        Returns
+        -------
+        color_helpers.GeneColorIndex
+        """
+        if isinstance(genes, str):
+            genes = [gene.strip() for gene in open(genes, 'r')]
+        counts = self.counts
+        counts.data  # run any pending operations first
+        index = ch.GeneColorIndex(counts, genes)
+        self._color_index = ((id(counts), counts.version), index)
+        return index
+
+    def gene_codes(self, gene_id):
+        """
+        Returns the precomputed color codes of gene_id, or None if the gene
+        is not in the color index (or the counts changed since it was
+        built). @see index_gene_colors()
+
+        Parameters
+        ----------
+        gene_id : basestring
+
+        Returns
+        -------
+        numpy.ndarray of uint8 codes into color_helpers.palette(), in the
+        order of counts.columns
+        """
+        if self._color_index is None:
+            return None
+        version, index = self._color_index
+        if version != (id(self.counts), self.counts.version) \
+                or gene_id not in index:
+            return None
+        return index.to_codes(gene_id)
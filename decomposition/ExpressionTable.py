@@ -1,10 +1,589 @@
+import copy
+import os
+import tempfile
+
 import numpy as np
 import pandas as pd
+from scipy import io
+from scipy import sparse
+
+import table_cache
+
+SPARSE_EXTENSIONS = ('.mtx', '.mtx.gz', '.npz')
+# rows parsed (and filtered) at a time when reading text tables.
+READ_CHUNKSIZE = 10000
+# per-gene scores ranked by ExpressionTable.top_variable()
+TOP_VARIABLE_METHODS = ('variance', 'dispersion')
+
+
+def is_sparse_file(data_file):
+    """
+    Returns True if data_file is a Matrix Market (.mtx) or scipy sparse
+    (.npz) matrix that should be loaded by SparseExpressionTable.
+
+    Parameters
+    ----------
+    data_file : basestring
+
+    Returns
+    -------
+    Boolean
+    """
+    return data_file.endswith(SPARSE_EXTENSIONS)
+
+
+def is_npy_file(data_file):
+    """
+    Returns True if data_file is a numpy .npy matrix that should be
+    memory-mapped by MappedExpressionTable.
+
+    Parameters
+    ----------
+    data_file : basestring
+
+    Returns
+    -------
+    Boolean
+    """
+    return data_file.endswith('.npy')
+
+
+def read_names(names_file, n):
+    """
+    Returns the labels listed (one per line, first tab-separated column)
+    in names_file, or 0..n-1 if names_file is None.
+
+    Parameters
+    ----------
+    names_file : basestring
+    n : int
+
+    Returns
+    -------
+    pandas.Index
+    """
+    if names_file is None:
+        return pd.Index(range(n))
+    names = pd.read_table(
+        names_file, header=None, usecols=[0], dtype=str
+    )[0]
+    return pd.Index(names)
+
+
+def allocate(shape, dtype, mmap_dir=None):
+    """
+    Returns an uninitialized array for a transform to write its result
+    to. If mmap_dir is set, the array is memory-mapped from a new file in
+    mmap_dir (removed right away, so it is freed once the array is), which
+    keeps large working buffers in the page cache rather than in process
+    memory. Mapped (genes, samples) buffers are laid out sample-major
+    (Fortran order), so a batch of samples is one contiguous span of the
+    file. @see ExpressionTable.iter_sample_chunks()
+
+    Parameters
+    ----------
+    shape : tuple
+    dtype : numpy.dtype
+    mmap_dir : basestring
+
+    Returns
+    -------
+    numpy.ndarray or numpy.memmap
+    """
+    if mmap_dir is None or not np.prod(shape):
+        return np.empty(shape, dtype=dtype)
+    fd, path = tempfile.mkstemp(suffix='.npy', dir=mmap_dir)
+    os.close(fd)
+    try:
+        return np.lib.format.open_memmap(
+            path, mode='w+', dtype=dtype, shape=shape,
+            fortran_order=len(shape) == 2
+        )
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def is_mapped(values):
+    """ True if values are (a view of) a memory-mapped file """
+    while isinstance(values, np.ndarray):
+        if isinstance(values, np.memmap):
+            return True
+        values = values.base
+    return False
+
+
+def take_rows(values, positions=None, dtype=None, mmap_dir=None):
+    """
+    Copies rows of values into a new array from allocate(), READ_CHUNKSIZE
+    rows at a time so that a memory-mapped source is paged in a chunk at a
+    time.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+    positions : numpy.ndarray
+        row positions to copy, in this order (all rows if None)
+    dtype : numpy.dtype
+        dtype of the copy (that of values if None)
+    mmap_dir : basestring
+        @see allocate()
+
+    Returns
+    -------
+    numpy.ndarray or numpy.memmap
+    """
+    n_rows = values.shape[0] if positions is None else len(positions)
+    out = allocate(
+        (n_rows, values.shape[1]),
+        values.dtype if dtype is None else dtype,
+        mmap_dir
+    )
+    for start in range(0, n_rows, READ_CHUNKSIZE):
+        stop = start + READ_CHUNKSIZE
+        if positions is None:
+            out[start:stop] = values[start:stop]
+        else:
+            out[start:stop] = values[positions[start:stop]]
+    return out
+
+
+def row_variability(mean, var, method='variance'):
+    """
+    Scores rows by their variance, or by their dispersion (variance / mean,
+    0 for rows with a mean of 0).
+
+    Parameters
+    ----------
+    mean : numpy.ndarray
+    var : numpy.ndarray
+    method : basestring
+        one of TOP_VARIABLE_METHODS
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    if method not in TOP_VARIABLE_METHODS:
+        raise ValueError("unknown variability method: {}".format(method))
+    if method == 'variance':
+        return var
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dispersion = var / mean
+    dispersion[~np.isfinite(dispersion)] = 0
+    return dispersion
+
+
+def row_moments(values):
+    """
+    Returns the mean and variance of every row, READ_CHUNKSIZE rows at a
+    time so no temporary the size of values is allocated.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+
+    Returns
+    -------
+    (numpy.ndarray, numpy.ndarray)
+    """
+    mean = np.empty(values.shape[0])
+    var = np.empty(values.shape[0])
+    for start in range(0, values.shape[0], READ_CHUNKSIZE):
+        stop = start + READ_CHUNKSIZE
+        chunk = np.asarray(values[start:stop], dtype=np.float64)
+        mean[start:stop] = chunk.mean(axis=1)
+        var[start:stop] = chunk.var(axis=1)
+    return mean, var
+
+
+def top_positions(scores, n):
+    """
+    Returns the positions of the n highest scores, in their original
+    order (all positions if there are no more than n).
+
+    Parameters
+    ----------
+    scores : numpy.ndarray
+    n : int
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    if n >= len(scores):
+        return np.arange(len(scores))
+    scores = np.where(np.isnan(scores), -np.inf, scores)
+    return np.sort(np.argpartition(-scores, n - 1)[:n])
+
+
+def read_featurecounts(counts_file, dtype=np.int32, chunksize=None):
+    """
+    Reads a featureCounts counts.txt, skipping the Chr/Start/End/Strand
+    annotation columns at parse time and reading counts directly as dtype.
+
+    Parameters
+    ----------
+    counts_file : basestring
+        featureCounts counts.txt formatted as:
+
+        Geneid	Chr	Start	End	Strand	Length  expression**
+    dtype : numpy.dtype
+        dtype of the count columns. With an integer dtype, chunks holding
+        fractional counts (ie. featureCounts -M --fraction) are read as
+        float64 instead.
+    chunksize : int
+        parse this many rows at a time to bound the parser's working
+        memory (READ_CHUNKSIZE if None)
+
+    Returns
+    -------
+    counts : pandas.DataFrame
+        table of (genes, samples) counts
+    length : pandas.Series
+        gene lengths
+    """
+    return filter_rows(iter_featurecounts(counts_file, dtype, chunksize))
+
+
+def featurecounts_header(counts_file):
+    """
+    Returns the column names of a featureCounts counts.txt (the first
+    line not starting with '#').
+
+    Returns
+    -------
+    list of basestring
+        Geneid, Chr, Start, End, Strand, Length, then the samples
+    """
+    with open(counts_file) as f:
+        for line in f:
+            if not line.startswith('#'):
+                names = line.rstrip('\r\n').split('\t')
+                break
+        else:
+            raise ValueError(
+                "{} has no featureCounts header line".format(counts_file)
+            )
+    if len(names) < 6:
+        raise ValueError(
+            "{} is not featureCounts output (expected Geneid, Chr, Start, "
+            "End, Strand and Length columns)".format(counts_file)
+        )
+    return names
+
+
+def iter_featurecounts(counts_file, dtype=np.int32, chunksize=None):
+    """
+    Parses a featureCounts counts.txt chunksize rows at a time.
+    @see read_featurecounts()
+
+    Returns
+    -------
+    generator of (pandas.DataFrame, pandas.Series) counts and lengths
+        at least one (empty if the table has no rows)
+    """
+    names = featurecounts_header(counts_file)
+
+    # Geneid, then Length and the sample columns
+    usecols = [0, 5] + list(range(6, len(names)))
+    dtypes = {names[5]: np.int32}
+    is_integer = np.issubdtype(dtype, np.integer)
+    if not is_integer:
+        dtypes.update((name, dtype) for name in names[6:])
+
+    fractional = False
+    empty = True
+    for chunk in pd.read_table(
+        counts_file,
+        index_col=0,
+        comment='#',
+        usecols=usecols,
+        dtype=dtypes,
+        chunksize=chunksize or READ_CHUNKSIZE
+    ):
+        if chunk.empty:
+            # header only (pandas may also drop the sample columns)
+            continue
+        empty = False
+        counts = chunk.iloc[:, 1:]
+        if is_integer:
+            # counts are parsed as inferred, then narrowed if whole
+            if all(
+                    np.issubdtype(t, np.integer) for t in counts.dtypes):
+                counts = counts.astype(dtype)
+            else:
+                if not fractional:
+                    fractional = True
+                    print("warning, fractional counts in {}, reading them "
+                          "as float64".format(counts_file))
+                counts = counts.astype(np.float64)
+        yield counts, chunk.iloc[:, 0]
+    if empty:
+        yield (
+            pd.DataFrame(columns=names[6:], dtype=dtype),
+            pd.Series(dtype=np.int32, name=names[5])
+        )
+
+
+def iter_table(data_file, chunksize=None, dtype=None):
+    """
+    Parses a generic (index in the first column, header in the first row)
+    table chunksize rows at a time.
+
+    Parameters
+    ----------
+    data_file : basestring
+    chunksize : int
+    dtype : numpy.dtype
+        each chunk is cast to this as it is parsed (ie. np.float32), so
+        the table is never held at the parsed precision. As parsed if None.
+
+    Returns
+    -------
+    generator of (pandas.DataFrame, None)
+        at least one (empty if the table has no rows)
+    """
+    empty = True
+    for chunk in pd.read_table(
+        data_file, index_col=0, chunksize=chunksize or READ_CHUNKSIZE
+    ):
+        empty = False
+        if dtype is not None:
+            chunk = chunk.astype(dtype, copy=False)
+        yield chunk, None
+    if empty:
+        chunk = pd.read_table(data_file, index_col=0, nrows=0)
+        if dtype is not None:
+            chunk = chunk.astype(dtype)
+        yield chunk, None
+
+
+def table_kind(dtype=None):
+    """
+    Returns the cache kind of a generic table parsed as dtype
+    (@see iter_table()), so parses at different precisions are cached
+    apart. @see table_cache.cache_entry()
+
+    Parameters
+    ----------
+    dtype : numpy.dtype
+
+    Returns
+    -------
+    basestring
+    """
+    if dtype is None:
+        return 'table'
+    return 'table.{}'.format(np.dtype(dtype).name)
+
+
+def filter_rows(chunks, rows=None, min_row_sum=None, columns=None,
+                sizes=None):
+    """
+    Concatenates parsed chunks, dropping unwanted rows from each chunk as
+    it arrives so the unfiltered matrix is never held in memory. Inputs
+    without rows, or with every row filtered out, give an empty table.
+
+    Parameters
+    ----------
+    chunks : iterable
+        (pandas.DataFrame, pandas.Series or None) data and lengths
+    rows : list
+        only keep rows with these ids, in this order (all if None)
+    min_row_sum : float
+        only keep rows whose sum is at least this (all if None)
+    columns : pandas.Index
+        columns of the empty table returned if there are no chunks at all
+    sizes : dict
+        if given, the number of rows 'read', left after the 'subset' to
+        rows and 'kept' in the end are stored in it
+
+    Returns
+    -------
+    (pandas.DataFrame, pandas.Series or None)
+    """
+    keep_ids = None if rows is None else set(rows)
+    kept = []
+    kept_lengths = []
+    n_read = 0
+    n_subset = 0
+    for data, length in chunks:
+        keep = np.ones(data.shape[0], dtype=bool)
+        n_read += data.shape[0]
+        if keep_ids is not None:
+            keep &= data.index.isin(keep_ids)
+        n_subset += keep.sum()
+        if min_row_sum is not None:
+            keep &= data.sum(axis=1).values >= min_row_sum
+        if not keep.all():
+            data = data[keep]
+            if length is not None:
+                length = length[keep]
+        kept.append(data)
+        if length is not None:
+            kept_lengths.append(length)
+
+    if not kept:
+        data = pd.DataFrame(columns=columns, dtype=np.float64)
+        if sizes is not None:
+            sizes.update(read=0, subset=0, kept=0)
+        return data, None
+    data = pd.concat(kept) if len(kept) > 1 else kept[0]
+    if rows is not None:
+        data = data.reindex(rows).dropna(axis=0)
+    if sizes is not None:
+        sizes.update(
+            read=n_read,
+            subset=n_subset if min_row_sum is not None else data.shape[0],
+            kept=data.shape[0]
+        )
+    if not kept_lengths:
+        length = None
+    elif len(kept_lengths) > 1:
+        length = pd.concat(kept_lengths)
+    else:
+        length = kept_lengths[0]
+    return data, length
 
 
-class ExpressionTable():
+def cached_read(data_file, kind, cache_dir, read_chunks,
+                rows=None, min_row_sum=None, mmap=False, mmap_dir=None,
+                sizes=None):
+    """
+    Returns (data, length) for data_file, filtered as it is read. Chunks
+    come from the binary cache in cache_dir if present, otherwise from
+    read_chunks() (and are stored as they are parsed).
+
+    Parameters
+    ----------
+    data_file : basestring
+    kind : basestring
+        which parser produced the result. @see table_cache.cache_entry
+    cache_dir : basestring
+        no caching if None
+    read_chunks : function
+        parses data_file, yielding (pandas.DataFrame, pandas.Series or None)
+        chunks
+    rows : list
+        @see filter_rows()
+    min_row_sum : float
+        @see filter_rows()
+    mmap : Boolean
+        back the returned data by the cache entry's memory-mapped values
+        instead of reading them into memory (requires cache_dir). Only the
+        rows kept by rows and min_row_sum are copied, if any are dropped.
+    mmap_dir : basestring
+        @see mapped_rows()
+    sizes : dict
+        @see filter_rows()
+
+    Returns
+    -------
+    (pandas.DataFrame, pandas.Series or None)
+    """
+    if cache_dir is None:
+        if mmap:
+            print("warning, no cache directory to memory-map {} from, "
+                  "reading it into memory".format(data_file))
+        return filter_rows(read_chunks(), rows, min_row_sum, sizes=sizes)
 
-    def __init__(self, data_file, lengths_file = None):
+    if mmap:
+        entry = table_cache.load_values(cache_dir, data_file, kind)
+        if entry is None:
+            # parse once (chunk by chunk) just to store the entry. Chunks
+            # are only kept once the cache declined to store them, as the
+            # parse is then the result.
+            errors = []
+            declined = []  # per chunk, whether storing had failed by then
+
+            def unstored():
+                for chunk in table_cache.store_chunks(
+                    cache_dir, data_file, kind, read_chunks(), errors=errors
+                ):
+                    declined.append(bool(errors))
+                    if errors:
+                        yield chunk
+            result = filter_rows(unstored(), rows, min_row_sum, sizes=sizes)
+            if declined and all(declined):
+                return result
+            # stored, or failed part way (parsed again below)
+            del result
+            entry = table_cache.load_values(cache_dir, data_file, kind)
+        if entry is not None:
+            return mapped_rows(
+                *entry, rows=rows, min_row_sum=min_row_sum,
+                mmap_dir=mmap_dir, sizes=sizes
+            )
+
+    chunks = table_cache.load_chunks(
+        cache_dir, data_file, kind, READ_CHUNKSIZE
+    )
+    if chunks is None:
+        chunks = table_cache.store_chunks(
+            cache_dir, data_file, kind, read_chunks()
+        )
+    return filter_rows(chunks, rows, min_row_sum, sizes=sizes)
+
+
+def mapped_rows(values, index, columns, length, rows=None,
+                min_row_sum=None, mmap_dir=None, sizes=None):
+    """
+    Wraps memory-mapped (genes, samples) values in a DataFrame without
+    copying them, unless rows are filtered out. Row sums are computed
+    READ_CHUNKSIZE rows at a time. @see filter_rows()
+
+    Parameters
+    ----------
+    mmap_dir : basestring
+        where to map the copy of the kept rows. @see allocate()
+    sizes : dict
+        @see filter_rows()
+
+    Returns
+    -------
+    (pandas.DataFrame, pandas.Series or None)
+    """
+    if rows is not None:
+        positions = index.get_indexer(rows)
+        positions = positions[positions >= 0]
+    else:
+        positions = np.arange(len(index))
+    n_subset = len(positions)
+
+    if min_row_sum is not None:
+        sums = np.concatenate([
+            values[start:start + READ_CHUNKSIZE].sum(axis=1)
+            for start in range(0, max(len(index), 1), READ_CHUNKSIZE)
+        ])
+        positions = positions[sums[positions] >= min_row_sum]
+    if sizes is not None:
+        sizes.update(read=len(index), subset=n_subset, kept=len(positions))
+
+    if not np.array_equal(positions, np.arange(len(index))):
+        # only the kept rows are copied
+        values = take_rows(values, positions, mmap_dir=mmap_dir)
+        index = index[positions]
+        if length is not None:
+            length = length.iloc[positions]
+    data = pd.DataFrame(values, index=index, columns=columns, copy=False)
+    return data, length
+
+
+class ExpressionTable(object):
+
+    # bumped whenever data is replaced, so results computed from the
+    # table (ie. Experiment.pca()) can tell when they are stale.
+    version = 0
+
+    mmap_dir = None
+
+    is_sparse = False
+
+    def __init__(self, data_file, lengths_file = None, cache_dir = None,
+                 dtype = None, lazy = False, mmap = False, mmap_dir = None):
         """
 
         Parameters
@@ -13,24 +592,274 @@ class ExpressionTable():
             data file containing index in the first column, expression data
             in subsequent columns with header information in the first row.
         lengths_file : basestring
+        cache_dir : basestring
+            if set, the parsed table is stored here in binary form and
+            reused by later runs on the same (unmodified) data_file.
+            @see table_cache
+        dtype : numpy.dtype
+            float dtype used from load through normalization (ie.
+            np.float32 to halve memory). Values are kept as parsed if None.
+        lazy : Boolean
+            if True, the file is not read and subset(), min_row_sum_cutoff(),
+            as_rpkm(), as_log2() and normalize() are only recorded, until
+            self.data is first accessed. The recorded plan is then optimized
+            (subsets and raw-count cutoffs are pushed into the reader, row
+            filters are evaluated before any arithmetic) and run once.
+        mmap : Boolean
+            if True, self.data is backed by the memory-mapped values of the
+            cache entry (in cache_dir) rather than read into memory, ie. to
+            stream samples out of core. @see iter_sample_chunks()
+        mmap_dir : basestring
+            if set, filtered copies, dtype casts and normalized values are
+            written to memory-mapped files in this directory instead of
+            being allocated in memory. @see allocate()
 
         """
-        data = pd.read_table(data_file, index_col=0)
-        self.data = data
+        self.data_file = data_file
+        self.dtype = None if dtype is None else np.dtype(dtype).type
+        self.mmap_dir = mmap_dir
+        self._reader = lambda rows=None, min_row_sum=None, sizes=None: \
+            cached_read(
+                data_file, table_kind(self.dtype), cache_dir,
+                lambda: iter_table(data_file, dtype=self.dtype),
+                rows, min_row_sum, mmap, mmap_dir, sizes
+            )
+        self.length = None
+        self._init_state(lazy)
+
+        if lengths_file is not None:
+            self.length = self.set_lengths(lengths_file)
 
+    def _init_state(self, lazy):
         self._pseudocount = 0
         self._is_log2 = False
         self._is_rpkm = False
-        self._num_samples = self.data.shape[0]
+        self._rpkm_index = None
+        self._plan = []
+        self._data = None
+        # (step, rows before, rows after) of each row filter run
+        self.filter_log = []
+        self.lazy = lazy
+        if not lazy:
+            self._load()
 
-        if lengths_file is not None:
-            self.length = self.set_lengths(lengths_file)
+    @property
+    def data(self):
+        """
+        (genes, samples) expression table. Runs any pending (lazy)
+        operations first.
+        """
+        if self._data is None or self._plan:
+            self._materialize()
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self.version += 1
+
+    def _float_dtype(self):
+        """ float dtype that transforms should produce """
+        return self.dtype if self.dtype is not None else np.float64
+
+    @property
+    def index(self):
+        """ row (gene) labels """
+        return self.data.index
+
+    @property
+    def columns(self):
+        """ column (sample) labels (read from the header if lazy) """
+        if self._data is None:
+            return self._read_columns()
+        return self._data.columns
+
+    def _read_columns(self):
+        return pd.read_table(self.data_file, index_col=0, nrows=0).columns
+
+    @property
+    def shape(self):
+        """ (genes, samples) """
+        return self.data.shape
+
+    def row(self, attribute):
+        """
+        Returns the expression values of one row (gene) across all samples.
+
+        Parameters
+        ----------
+        attribute : basestring
+            row (gene) id
+
+        Returns
+        -------
+        pandas.Series
+        """
+        return self.data.loc[attribute]
+
+    def raw_row(self, attribute):
+        """
+        Returns the values of one row (gene) as loaded, before any pending
+        (lazy) operations. A table that has not been read yet reads just
+        that row, so its plan (and the row filters pushed into its reader)
+        is left untouched. @see _materialize()
+
+        Parameters
+        ----------
+        attribute : basestring
+            row (gene) id
+
+        Returns
+        -------
+        pandas.Series, or None if the table has no such row
+        """
+        if self._data is None:
+            data, _ = self._reader([attribute])
         else:
-            self.length = None
+            data = self._data
+        if attribute not in data.index:
+            return None
+        return data.loc[attribute]
+
+    def samples_by_features(self, dense=False):
+        """
+        Returns the (samples, features) matrix handed to the decomposers.
+
+        Parameters
+        ----------
+        dense : Boolean
+            ignored for dense tables. @see SparseExpressionTable
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        return self.data.T
+
+    def iter_sample_chunks(self, batch_size):
+        """
+        Yields the (samples, features) matrix batch_size samples at a time,
+        so that only one batch is held as a dense float array. Values
+        memory-mapped sample-major (cache entries and mmap_dir buffers) are
+        read one contiguous span per batch. @see sample_major()
+
+        Parameters
+        ----------
+        batch_size : int
+
+        Returns
+        -------
+        generator of numpy.ndarray
+        """
+        values = self.sample_major()
+        for start in range(0, values.shape[1], batch_size):
+            yield np.asarray(
+                values[:, start:start + batch_size].T,
+                dtype=self._float_dtype()
+            )
+
+    def sample_major(self):
+        """
+        Returns the (genes, samples) values, first copied (one sequential
+        pass) to a sample-major buffer in mmap_dir if they are memory-mapped
+        gene-major, ie. a C ordered .npy input. Slicing samples out of a
+        gene-major file would otherwise page in all of it for every batch.
+        The copy holds the same values, so it replaces them for later use.
+        Without a mmap_dir, the values are returned as they are.
+
+        Returns
+        -------
+        numpy.ndarray or numpy.memmap
+        """
+        values = self.data.values
+        if (values.flags.f_contiguous or self.mmap_dir is None or
+                not is_mapped(values)):
+            return values
+        values = take_rows(values, mmap_dir=self.mmap_dir)
+        # same values in another layout, so fits of the table stay valid
+        self._data = pd.DataFrame(
+            values, index=self._data.index, columns=self._data.columns,
+            copy=False
+        )
+        return values
+
+    def to_csv(self, path, sep='\t', float_format=None):
+        """
+        Writes the table to a delimited text file.
+
+        Parameters
+        ----------
+        path : basestring or file
+        sep : basestring
+        float_format : basestring
+            format string for floats, ie. '%.6g' (@see DataFrame.to_csv)
+
+        Returns
+        -------
+
+        """
+        self.data.to_csv(path, sep=sep, float_format=float_format)
+
+    def copy(self):
+        """
+        Returns a copy whose data and pending (lazy) operations can be
+        changed without affecting this table, ie. to run several jobs off
+        of one parse.
+
+        Returns
+        -------
+        ExpressionTable
+        """
+        other = copy.copy(self)
+        if self.is_sparse:
+            other._data = self._data.copy()
+        elif self._data is not None:
+            values = self._data.values
+            if values.flags.writeable:
+                other._data = pd.DataFrame(
+                    take_rows(values, mmap_dir=self.mmap_dir),
+                    index=self._data.index,
+                    columns=self._data.columns,
+                    copy=False
+                )
+            # read-only (memory-mapped) values are never written in place
+        other._plan = list(self._plan)
+        other.filter_log = list(self.filter_log)
+        return other
+
+    def normalization(self):
+        """
+        Returns how the current values were derived from the raw counts,
+        so that other samples can be normalized the same way.
+        @see projection.ProjectionModel
+
+        Returns
+        -------
+        dict
+            rpkm : Boolean
+            rpkm_genes : pandas.Index
+                genes whose counts made up each sample's mapped reads
+                (None unless rpkm)
+            lengths : numpy.ndarray
+                length of each gene of self.index (None unless rpkm)
+            log2 : Boolean
+            pseudocount : float
+        """
+        self.data  # run any pending operations first
+        lengths = None
+        if self._is_rpkm:
+            lengths = self.length.reindex(self.index).values
+        return dict(
+            rpkm=self._is_rpkm,
+            rpkm_genes=self._rpkm_index if self._is_rpkm else None,
+            lengths=lengths,
+            log2=self._is_log2,
+            pseudocount=self._pseudocount
+        )
 
     def as_log2(self, pseudocount=0):
         """
-        log2 transforms self.data
+        log2 transforms self.data (in place). @see normalize()
 
         Parameters
         ----------
@@ -41,9 +870,7 @@ class ExpressionTable():
         -------
 
         """
-        self._is_log2 = True
-        self._pseudocount = pseudocount
-        self.data = np.log2(self.data + pseudocount)
+        self._record(('log2', pseudocount))
 
     def subset(self, subset_file):
         """
@@ -59,7 +886,7 @@ class ExpressionTable():
 
         """
         attributes = [attr.strip() for attr in open(subset_file, 'r')]
-        self.data = self.data.loc[attributes, :].dropna(axis=0)
+        self._record(('subset', attributes))
 
     def min_row_sum_cutoff(self, min_expr_sum=0):
         """
@@ -75,13 +902,32 @@ class ExpressionTable():
         -------
 
         """
-        self.data = self.data[self.data.sum(axis=1) >= min_expr_sum]
-        if self.length is not None:
-            self.length = self.length.ix[self.data.index]
+        self._record(('cutoff', min_expr_sum))
+
+    def top_variable(self, n, method='variance'):
+        """
+        removes all but the n rows (genes) that vary most across samples,
+        scored on the table as transformed so far (ie. after log2).
+
+        Parameters
+        ----------
+        n : int
+            number of rows to keep
+        method : basestring
+            'variance' or 'dispersion' (variance / mean)
+            @see row_variability()
+
+        Returns
+        -------
+
+        """
+        if method not in TOP_VARIABLE_METHODS:
+            raise ValueError("unknown variability method: {}".format(method))
+        self._record(('top_variable', n, method))
 
     def as_rpkm(self):
         """
-        Transforms data into RPKM
+        Transforms data into RPKM (in place). @see normalize()
 
         Parameters
         ----------
@@ -94,20 +940,240 @@ class ExpressionTable():
         Returns
         -------
         """
+        self._record(('rpkm',))
 
-        counts = self.data
-        lengths = self.length
-        mapped_reads = counts.sum()
-        self.is_rpkm = True
-        self.data = (
-            counts * pow(10, 9)
-        ).div(
-            mapped_reads,
-            axis=1
-        ).div(
-            lengths,
-            axis=0
+    def normalize(self, rpkm=False, min_expr_sum=None, log2=False,
+                  pseudocount=0):
+        """
+        Applies the RPKM transform, the minimum row sum cutoff and the log2
+        transform (in that order, each optional) to the underlying ndarray
+        in place, using at most one working buffer instead of a full copy
+        of the matrix per step.
+
+        The cutoff is evaluated on RPKM row sums computed from the raw
+        counts (mapped reads are taken before filtering, as when calling
+        as_rpkm() then min_row_sum_cutoff()), so filtered rows are dropped
+        before any arithmetic is done on them.
+
+        Parameters
+        ----------
+        rpkm : Boolean
+            @see as_rpkm()
+        min_expr_sum : int
+            @see min_row_sum_cutoff(). No rows are removed if None.
+        log2 : Boolean
+            @see as_log2()
+        pseudocount : int
+            @see as_log2()
+
+        Returns
+        -------
+
+        """
+        if rpkm:
+            self._plan.append(('rpkm',))
+        if min_expr_sum is not None:
+            self._plan.append(('cutoff', min_expr_sum))
+        if log2:
+            self._plan.append(('log2', pseudocount))
+        self._record()
+
+    def _record(self, op=None):
+        """
+        Adds op to the plan, and runs the plan right away unless lazy.
+        """
+        if op is not None:
+            self._plan.append(op)
+        if not self.lazy:
+            self._materialize()
+
+    def _materialize(self):
+        """
+        Loads the table (if needed) and runs the recorded plan. Subsets
+        and cutoffs ahead of any arithmetic are pushed into the reader, and
+        consecutive rpkm/cutoff/log2 steps are fused into one in-place
+        pass. @see _normalize()
+        """
+        plan, self._plan = self._plan, []
+        if self._data is None:
+            rows, min_row_sum, plan = self._pushdown(plan)
+            self._load(rows, min_row_sum)
+
+        fused = {}
+        for op in plan:
+            if op[0] == 'subset':
+                self._flush(fused)
+                self._subset(op[1])
+            elif op[0] == 'top_variable':
+                self._flush(fused)
+                self._top_variable(op[1], op[2])
+            elif op[0] == 'rpkm':
+                self._flush(fused)
+                fused['rpkm'] = True
+            elif op[0] == 'cutoff':
+                if 'min_expr_sum' in fused or 'log2' in fused:
+                    self._flush(fused)
+                fused['min_expr_sum'] = op[1]
+            elif op[0] == 'log2':
+                if 'log2' in fused:
+                    self._flush(fused)
+                fused['log2'] = True
+                fused['pseudocount'] = op[1]
+        self._flush(fused)
+
+    def _flush(self, fused):
+        if fused:
+            self._normalize(**fused)
+            fused.clear()
+
+    @staticmethod
+    def _pushdown(plan):
+        """
+        Splits plan into row filters the reader can apply while loading
+        and the operations that must run afterwards. Subsets are row-local
+        until an rpkm (whose mapped reads depend on which rows are left),
+        cutoffs are only on raw counts before any rpkm/log2. Neither moves
+        ahead of a top_variable, which ranks the rows left at that point.
+
+        Returns
+        -------
+        rows : list
+            row ids to keep (in this order), or None
+        min_row_sum : float
+            minimum raw row sum, or None
+        plan : list
+            the remaining operations
+        """
+        rows = None
+        min_row_sum = None
+        remaining = []
+        for op in plan:
+            seen = set(o[0] for o in remaining)
+            if op[0] == 'subset' and not seen.intersection(
+                    ('rpkm', 'top_variable')):
+                if rows is None:
+                    rows = op[1]
+                else:
+                    kept = set(rows)
+                    rows = [attr for attr in op[1] if attr in kept]
+            elif op[0] == 'cutoff' and not seen.intersection(
+                    ('rpkm', 'log2', 'top_variable')):
+                if min_row_sum is None or op[1] > min_row_sum:
+                    min_row_sum = op[1]
+            else:
+                remaining.append(op)
+        return rows, min_row_sum, remaining
+
+    def _load(self, rows=None, min_row_sum=None):
+        """
+        Reads the table, keeping only rows (in that order) whose raw row
+        sum is at least min_row_sum. Rows are filtered chunk by chunk as
+        the file is parsed. @see filter_rows()
+        """
+        sizes = {}
+        data, length = self._reader(rows, min_row_sum, sizes)
+        if rows is not None:
+            self.filter_log.append(
+                ('subset', sizes['read'], sizes['subset'])
+            )
+        if min_row_sum is not None:
+            self.filter_log.append(
+                ('cutoff', sizes['subset'], sizes['kept'])
+            )
+        if self.dtype is not None and (data.dtypes != self.dtype).any():
+            data = pd.DataFrame(
+                take_rows(data.values, dtype=self.dtype,
+                          mmap_dir=self.mmap_dir),
+                index=data.index,
+                columns=data.columns,
+                copy=False
+            )
+        self.data = data
+        if length is not None:
+            self.length = length
+
+    def _subset(self, attributes):
+        before = self._data.shape[0]
+        self.data = self._data.reindex(attributes).dropna(axis=0)
+        self.filter_log.append(('subset', before, self._data.shape[0]))
+
+    def _top_variable(self, n, method):
+        """
+        @see top_variable()
+        """
+        values = self._data.values
+        positions = top_positions(
+            row_variability(*row_moments(values), method=method), n
+        )
+        self.filter_log.append(
+            ('top_variable', values.shape[0], len(positions))
+        )
+        if len(positions) == values.shape[0]:
+            return
+        index = self._data.index[positions]
+        self.data = pd.DataFrame(
+            take_rows(values, positions, mmap_dir=self.mmap_dir),
+            index=index, columns=self._data.columns, copy=False
+        )
+        if self.length is not None:
+            self.length = self.length.reindex(index)
+
+    def _normalize(self, rpkm=False, min_expr_sum=None, log2=False,
+                   pseudocount=0):
+        """
+        @see normalize()
+        """
+        dtype = self._float_dtype()
+        values = self._data.values
+        index = self._data.index
+
+        if rpkm:
+            lengths = self.length.reindex(index).values.astype(dtype)
+            mapped_reads = values.sum(axis=0).astype(dtype)
+            col_scale = dtype(pow(10, 9)) / mapped_reads
+
+        if min_expr_sum is not None:
+            if rpkm:
+                row_sums = values.dot(col_scale) / lengths
+            else:
+                row_sums = values.sum(axis=1)
+            keep = row_sums >= min_expr_sum
+            self.filter_log.append(
+                ('cutoff', values.shape[0], int(keep.sum()))
+            )
+        else:
+            keep = None
+
+        if keep is not None and not keep.all():
+            # the compacted copy doubles as the working buffer
+            values = take_rows(
+                values, np.flatnonzero(keep),
+                dtype if rpkm or log2 else None, self.mmap_dir
+            )
+            index = index[keep]
+            if rpkm:
+                lengths = lengths[keep]
+        elif (rpkm or log2) and (
+            values.dtype != dtype or not values.flags.writeable
+        ):
+            values = take_rows(values, dtype=dtype, mmap_dir=self.mmap_dir)
+
+        if rpkm:
+            self._is_rpkm = True
+            self._rpkm_index = self._data.index
+            values *= col_scale
+            values /= lengths[:, np.newaxis]
+        if log2:
+            self._is_log2 = True
+            self._pseudocount = pseudocount
+            values += pseudocount
+            np.log2(values, out=values)
+
+        self.data = pd.DataFrame(
+            values, index=index, columns=self._data.columns, copy=False
         )
+        if keep is not None and self.length is not None:
+            self.length = self.length.reindex(index)
 
     def set_lengths(self, lengths_file):
         """
@@ -143,18 +1209,362 @@ class FeatureCountsTable(ExpressionTable):
     This class uses featurecounts counts.txt to populate gene and gene len
     info.
     """
-    def __init__(self, counts_file):
+    def __init__(self, counts_file, cache_dir=None, dtype=np.int32,
+                 chunksize=None, lazy=False, mmap=False, mmap_dir=None):
         """
 
         Parameters
         ----------
         counts_file : basestring
             featureCounts counts.txt
+        cache_dir : basestring
+            @see ExpressionTable
+        dtype : numpy.dtype
+            dtype of the count columns. @see read_featurecounts
+            Float dtypes (ie. np.float32) are also kept through
+            normalization. @see ExpressionTable
+        chunksize : int
+            rows parsed at a time. @see read_featurecounts
+        lazy : Boolean
+            @see ExpressionTable
+        mmap : Boolean
+            @see ExpressionTable
+        mmap_dir : basestring
+            @see ExpressionTable
+        """
+        self.data_file = counts_file
+        self.mmap_dir = mmap_dir
+        self._reader = lambda rows=None, min_row_sum=None, sizes=None: \
+            cached_read(
+                counts_file,
+                'featurecounts.{}'.format(np.dtype(dtype).name),
+                cache_dir,
+                lambda: iter_featurecounts(counts_file, dtype, chunksize),
+                rows, min_row_sum, mmap, mmap_dir, sizes
+            )
+        if np.issubdtype(dtype, np.floating):
+            self.dtype = np.dtype(dtype).type
+        else:
+            self.dtype = None
+        self.length = None
+        self._init_state(lazy)
+
+    def _read_columns(self):
+        return pd.Index(featurecounts_header(self.data_file)[6:])
+
+
+class MappedExpressionTable(ExpressionTable):
+    """
+    This class memory-maps a (genes, samples) numpy .npy matrix rather
+    than reading it, so that concurrent processes working on the same
+    matrix share one page-cached copy of it. Row and column labels are
+    read from line-delimited sidecar files.
+    """
+    def __init__(self, data_file, row_names_file=None, col_names_file=None,
+                 dtype=None, lazy=False, mmap_dir=None):
         """
-        counts = pd.read_table(counts_file, index_col=0, comment='#')
-        # counts = pd.read_table(counts_file, index_col=0, skiprows=1)
-        self.data = counts.ix[:,5:]
-        self.length = counts['Length']
+
+        Parameters
+        ----------
+        data_file : basestring
+            .npy matrix of (genes, samples) values
+        row_names_file : basestring
+            line-delimited file of gene ids. Rows are numbered if None.
+        col_names_file : basestring
+            line-delimited file of sample ids. Columns are numbered if None.
+        dtype : numpy.dtype
+            @see ExpressionTable
+        lazy : Boolean
+            @see ExpressionTable
+        mmap_dir : basestring
+            @see ExpressionTable
+        """
+        self.data_file = data_file
+        self.dtype = None if dtype is None else np.dtype(dtype).type
+        self.mmap_dir = mmap_dir
+        self._row_names_file = row_names_file
+        self._col_names_file = col_names_file
+        self._reader = lambda rows=None, min_row_sum=None, sizes=None: \
+            mapped_rows(
+                *self._read_npy(), rows=rows, min_row_sum=min_row_sum,
+                mmap_dir=mmap_dir, sizes=sizes
+            )
+        self.length = None
+        self._init_state(lazy)
+
+    def _read_npy(self):
+        values = np.load(self.data_file, mmap_mode='r')
+        index = read_names(self._row_names_file, values.shape[0])
+        if len(index) != values.shape[0]:
+            raise ValueError("{} row names for {} rows of {}".format(
+                len(index), values.shape[0], self.data_file
+            ))
+        return values, index, self._read_columns(values.shape[1]), None
+
+    def _read_columns(self, n=None):
+        if n is None:
+            n = np.load(self.data_file, mmap_mode='r').shape[1]
+        columns = read_names(self._col_names_file, n)
+        if len(columns) != n:
+            raise ValueError("{} column names for {} columns of {}".format(
+                len(columns), n, self.data_file
+            ))
+        return columns
+
+
+class SparseExpressionTable(ExpressionTable):
+    """
+    This class holds mostly-zero (ie. scRNA) count matrices as a
+    scipy.sparse CSR matrix of (genes, samples) so that filtering and
+    normalization never densify the data.
+    """
+
+    is_sparse = True
+
+    def __init__(self, data_file, row_names_file=None, col_names_file=None,
+                 lengths_file=None, dtype=None):
+        """
+
+        Parameters
+        ----------
+        data_file : basestring
+            Matrix Market (.mtx, .mtx.gz) or scipy.sparse (.npz) matrix of
+            (genes, samples), ie. a 10x matrix.mtx
+        row_names_file : basestring
+            line-delimited file of gene ids (only the first tab-separated
+            column is used, ie. a 10x genes.tsv). Rows are numbered if None.
+        col_names_file : basestring
+            line-delimited file of sample ids (ie. a 10x barcodes.tsv).
+            Columns are numbered if None.
+        lengths_file : basestring
+            tab delimited file containing the gene name and corresponding
+            length. Must contain header information.
+        dtype : numpy.dtype
+            @see ExpressionTable
+        """
+        if data_file.endswith('.npz'):
+            data = sparse.load_npz(data_file)
+        else:
+            data = io.mmread(data_file)
+        if dtype is not None:
+            dtype = np.dtype(dtype).type
+        self._plan = []
+        self.filter_log = []
+        self.lazy = False
+        self.data = sparse.csr_matrix(data, dtype=dtype)
+        self.dtype = dtype
+
+        self._index = read_names(row_names_file, self.data.shape[0])
+        self._columns = read_names(col_names_file, self.data.shape[1])
 
         self._pseudocount = 0
+        self._is_log2 = False
         self._is_rpkm = False
+        self._rpkm_index = None
+        self._num_samples = self.data.shape[0]
+
+        if lengths_file is not None:
+            self.length = pd.read_table(
+                lengths_file, index_col=0
+            ).iloc[:, 0].reindex(self._index)
+        else:
+            self.length = None
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def columns(self):
+        return self._columns
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def row(self, attribute):
+        values = self.data[self._index.get_loc(attribute)].toarray().ravel()
+        return pd.Series(values, index=self._columns, name=attribute)
+
+    def raw_row(self, attribute):
+        """ @see ExpressionTable.raw_row() (sparse tables are never lazy) """
+        if attribute not in self._index:
+            return None
+        return self.row(attribute)
+
+    def samples_by_features(self, dense=False):
+        """
+        Returns the (samples, features) matrix handed to the decomposers.
+
+        Parameters
+        ----------
+        dense : Boolean
+            densify the matrix for estimators that do not accept
+            scipy.sparse input (FastICA, exact TSNE)
+
+        Returns
+        -------
+        scipy.sparse.csc_matrix or numpy.ndarray
+        """
+        if dense:
+            return self.data.T.toarray()
+        return self.data.T
+
+    def iter_sample_chunks(self, batch_size):
+        """
+        Yields the (samples, features) matrix batch_size samples at a time,
+        densifying one batch at a time. @see ExpressionTable
+
+        Returns
+        -------
+        generator of numpy.ndarray
+        """
+        data = self.data.tocsc()
+        for start in range(0, data.shape[1], batch_size):
+            yield np.asarray(
+                data[:, start:start + batch_size].T.toarray(),
+                dtype=self._float_dtype()
+            )
+
+    def to_csv(self, path, sep='\t', float_format=None, chunksize=1000):
+        """
+        Writes the table to a delimited text file, densifying only
+        chunksize rows at a time.
+
+        Parameters
+        ----------
+        path : basestring or file
+        sep : basestring
+        float_format : basestring
+            @see ExpressionTable.to_csv()
+        chunksize : int
+
+        Returns
+        -------
+
+        """
+        if not hasattr(path, 'write'):
+            with open(path, 'w') as f:
+                return self.to_csv(f, sep, float_format, chunksize)
+        for start in range(0, self.data.shape[0], chunksize):
+            stop = start + chunksize
+            pd.DataFrame(
+                self.data[start:stop].toarray(),
+                index=self._index[start:stop],
+                columns=self._columns
+            ).to_csv(path, sep=sep, float_format=float_format,
+                     header=(start == 0))
+
+    def as_log2(self, pseudocount=0):
+        """
+        log2 transforms the nonzero entries of self.data. Only a pseudocount
+        of 1 keeps zeros at zero, anything else would densify the matrix.
+
+        Parameters
+        ----------
+        pseudocount : int
+            must be 1
+
+        Returns
+        -------
+
+        """
+        if pseudocount != 1:
+            raise ValueError(
+                "sparse tables can only be log2(x + 1) transformed, "
+                "pseudocount {} would densify the matrix".format(pseudocount)
+            )
+        self._is_log2 = True
+        self._pseudocount = pseudocount
+        self.data = self.data.astype(self._float_dtype())
+        self.data.data = np.log2(self.data.data + pseudocount)
+
+    def subset(self, subset_file):
+        """
+        removes any row (gene) that is NOT contained in the subset file
+
+        Parameters
+        ----------
+        subset_file : basestring
+            line-delimited file name of gene ids to subset the raw matrix on.
+
+        Returns
+        -------
+
+        """
+        attributes = [attr.strip() for attr in open(subset_file, 'r')]
+        positions = self._index.get_indexer(attributes)
+        self._take_rows(positions[positions >= 0], 'subset')
+
+    def min_row_sum_cutoff(self, min_expr_sum=0):
+        """
+        removes any row (gene) that does NOT meet the minimum row sum
+        of read counts (or RPKM if flagged) requirements.
+
+        Parameters
+        ----------
+        min_expr_sum : int
+            sum across all samples to filter
+
+        Returns
+        -------
+
+        """
+        row_sums = np.asarray(self.data.sum(axis=1)).ravel()
+        self._take_rows(np.flatnonzero(row_sums >= min_expr_sum), 'cutoff')
+
+    def top_variable(self, n, method='variance'):
+        """
+        removes all but the n rows (genes) that vary most across samples.
+        Moments are computed from the stored nonzero values, without
+        densifying the matrix. @see ExpressionTable.top_variable()
+        """
+        data = self.data.astype(np.float64)
+        mean = np.asarray(data.mean(axis=1)).ravel()
+        sq_mean = np.asarray(data.multiply(data).mean(axis=1)).ravel()
+        var = np.maximum(sq_mean - mean * mean, 0)
+        positions = top_positions(row_variability(mean, var, method), n)
+        if len(positions) < data.shape[0]:
+            self._take_rows(positions, 'top_variable')
+
+    def as_rpkm(self):
+        """
+        Transforms data into RPKM by scaling rows by 1/length and columns
+        by 10^9/mapped reads, which keeps the matrix sparse.
+
+        Returns
+        -------
+        """
+        if self.length is None:
+            raise ValueError("RPKM requires gene lengths (lengths_file)")
+        dtype = self._float_dtype()
+        mapped_reads = np.asarray(self.data.sum(axis=0)).ravel().astype(dtype)
+        self._is_rpkm = True
+        self._rpkm_index = self._index
+        self.data = sparse.csr_matrix(
+            sparse.diags(1 / self.length.values.astype(dtype)).dot(
+                self.data.astype(dtype)
+            ).dot(
+                sparse.diags(dtype(pow(10, 9)) / mapped_reads)
+            )
+        )
+
+    def normalize(self, rpkm=False, min_expr_sum=None, log2=False,
+                  pseudocount=0):
+        """
+        @see ExpressionTable.normalize(). Each sparse step already only
+        touches the stored nonzero values.
+        """
+        if rpkm:
+            self.as_rpkm()
+        if min_expr_sum is not None:
+            self.min_row_sum_cutoff(min_expr_sum)
+        if log2:
+            self.as_log2(pseudocount)
+
+    def _take_rows(self, positions, step):
+        self.filter_log.append((step, self.data.shape[0], len(positions)))
+        self.data = self.data[positions]
+        self._index = self._index[positions]
+        if self.length is not None:
+            self.length = self.length.iloc[positions]
@@ -4,10 +4,11 @@ matplotlib.use('Agg')
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from sklearn.decomposition import FastICA
-from bokeh.models import ColumnDataSource
 
+import bokeh_helpers as bh
 import color_helpers as ch
+import component_helpers as cph
+import matplotlib_helpers as mh
 
 __all__ = []
 __version__ = 0.1
@@ -15,10 +16,12 @@ __date__ = '2017-2-13'
 __updated__ = '2017-2-13'
 
 
-class _ICAPlotter():
+class _ICAPlotter(object):
 
     def __init__(self, expt, cmap = 'Purples',
-                 algorithm = 'parallel', random_state = 1):
+                 algorithm = 'parallel', random_state = 1,
+                 n_components = None, incremental = False,
+                 batch_size = None):
         """
 
         Parameters
@@ -31,56 +34,122 @@ class _ICAPlotter():
         random_state : int
             tsne random state for tsne seed generator
             @see TSNE(random_state)
+        n_components : int
+            only unmix this many leading principal components (all, as
+            FastICA does, if None; RANDOMIZED_N_COMPONENTS for sparse
+            tables). @see component_helpers.ica_pca_params()
+        incremental : Boolean
+            whiten the experiment's out-of-core IncrementalPCA of
+            n_components (as many as it fits by default) instead
+        batch_size : int
+            samples per batch of the incremental PCA
         """
 
         self.algorithm = algorithm
         self.random_state = random_state
+        self.n_components = n_components
+        self.incremental = incremental
+        self.batch_size = batch_size
         self.cmap = plt.get_cmap(cmap)
         self.expt = expt
-        self.ica, self.icacomp = self._fit_transform()
-        self.source = self._columnsource()
+        self.ica, self.icacomp, self.components = self._fit_transform()
+        self._source = None
+        self._density = None
 
-    def get_independent_components(self):
+    @property
+    def source(self):
         """
-        Returns a DataFrame of how much each feature contributes to the PC.
+        bokeh.models.ColumnDataSource of the plotted points, built (and
+        bokeh imported) the first time it is used. @see _columnsource()
+        """
+        if self._source is None:
+            self._source = self._columnsource()
+        return self._source
+
+    def get_independent_components(self, n_components=None, n_features=None):
+        """
+        Returns a DataFrame of how much each feature contributes to the IC.
+
+        Parameters
+        ----------
+        n_components : int
+            only return the first n_components ICs (all if None)
+        n_features : int
+            only return features in the top n_features of any returned IC
+            (all if None)
 
         Returns
         -------
-        pc_components : pandas.DataFrame
+        ic_components : pandas.DataFrame
 
         """
-        ic_cols = range(len(self.ica.components_))
-        ic_components = pd.DataFrame(
-            index=self.expt.counts.data.index,
-            columns=ic_cols
+        return cph.components_to_loadings(
+            self.components,
+            self.expt.counts.index,
+            n_components=n_components,
+            n_features=n_features
         )
-        print(ic_components.shape)
-        for n in range(0, len(self.ica.components_)):
-            for i, j in zip(
-                    self.expt.counts.data.index,
-                    np.abs(self.ica.components_[n])
-            ):
-                ic_components.ix[i, n] = j
 
-        return ic_components
+    def projection(self):
+        """
+        Returns the fit as a linear map of the expression of the genes in
+        self.expt.counts.index: icacomp = dot(values - mean, components.T),
+        samples as rows. Whitening centers the components, so mean is
+        that of the fitted samples. @see projection.ProjectionModel
+
+        Returns
+        -------
+        mean : numpy.ndarray
+            (features,) mean expression of the fitted samples
+        components : numpy.ndarray
+            (components, features) @see get_independent_components()
+        """
+        pca = self._whitening_pca()[0]
+        mean = getattr(pca, 'mean_', None)
+        if mean is None:
+            # TruncatedSVD (sparse tables) is fit uncentered
+            mean = np.asarray(self.expt.counts.data.mean(axis=1)).ravel()
+        return mean, self.components
+
+    def _whitening_pca(self):
+        """ the experiment's (shared) PCA that is whitened and unmixed """
+        return self.expt.pca(*cph.ica_pca_params(
+            self.expt.counts.is_sparse, self.n_components, self.incremental
+        ), batch_size=self.batch_size)
 
     def _fit_transform(self):
         """
-        Transforms the expression data to principal component space.
+        Unmixes the samples into independent components. Rather than
+        having FastICA whiten (another SVD of) the matrix, the experiment's
+        shared PCA scores are whitened and unmixed. @see Experiment.pca()
+        and component_helpers.ica_pca_params()
 
         Returns
         -------
-        prcomp : pandas.DataFrame
-            table containing principle components ordered by variance
+        ica : sklearn.decomposition.FastICA
+            fitted to the whitened principal components
+        icacomp : pandas.DataFrame
+            table containing the independent components of each sample
+        components : numpy.ndarray
+            (components, features) unmixing matrix in feature (gene) space
         """
+        from sklearn.decomposition import FastICA
 
-        decomposer = FastICA(algorithm=self.algorithm, random_state = self.random_state)
-        icacomp = decomposer.fit_transform(self.expt.counts.data.T)
-        icacomp = pd.DataFrame(icacomp, index=self.expt.counts.data.columns)
-        return decomposer, icacomp
+        pca, prcomp = self._whitening_pca()
+        whitened, keep, scale = cph.whiten(prcomp.values)
+
+        decomposer = FastICA(algorithm=self.algorithm, whiten=False,
+                             random_state = self.random_state)
+        icacomp = decomposer.fit_transform(whitened)
+        icacomp = pd.DataFrame(icacomp, index=self.expt.counts.columns)
+        components = np.dot(
+            decomposer.components_ / scale, pca.components_[keep]
+        )
+        return decomposer, icacomp, components
 
     def _columnsource(self):
         """
+        Creates and returns the ColumnDataSource object needed by Bokeh plots.
 
         Returns
         -------
@@ -88,28 +157,37 @@ class _ICAPlotter():
             Object which allows set_color() method to
             interactively update colors in bokeh.
         """
+        return bh.columnsource(
+            self.icacomp[0],
+            self.icacomp[1],
+            self.icacomp.index,
+            self._color_codes()
+        )
+
+    def _color_codes(self):
+        """
+        Returns the palette code of each plotted sample from the metadata
+        colors. @see color_helpers.expr_series_to_codes()
 
-        self.expt.metadata['hex'] = ch.expr_series_to_hex(
-            self.expt.metadata['color'],
-            self.cmap,
+        Returns
+        -------
+        numpy.ndarray of uint8
+        """
+        return ch.expr_series_to_codes(
+            self.expt.metadata['color'].reindex(self.icacomp.index),
             is_norm=True
         )
-        return ColumnDataSource(
-            data=dict(
-                x=self.icacomp[0],
-                y=self.icacomp[1],
-                idx=self.icacomp.index,
-                fill_color=self.expt.metadata['hex'],
-            )
-        )
 
-    def _matplotlib(self, ax=None):
+    def _matplotlib(self, ax=None, rasterized=False):
         """
+        Draws all samples with one scatter call. @see matplotlib_helpers
 
         Parameters
         ----------
         ax : matplotlib.axes._subplots.AxesSubplot
             subplot axes
+        rasterized : Boolean
+            draw the points as one image in vector (pdf, svg) output
 
         Returns
         -------
@@ -118,16 +196,16 @@ class _ICAPlotter():
         if ax is None:
             ax = plt.gca()
 
-        for c in set(self.expt.metadata['condition']):
-            indices = self.icacomp.ix[self.expt.metadata[self.expt.metadata['condition'] == c].index]
-
-            color = self.expt.metadata[self.expt.metadata['condition'] == c]['color']
-            rgbs = [self.cmap(n / self.expt.metadata['color'].max()) for n in color]
-
-            ax.scatter(indices[0], indices[1], label=c, color=rgbs)
+        metadata = self.expt.metadata.reindex(self.icacomp.index)
+        mh.scatter(ax, self.icacomp, metadata['condition'],
+                   mh.metadata_to_rgba(metadata['color'], self.cmap),
+                   rasterized=rasterized)
 
     def _bokeh(self, ax):
         """
+        Draws the samples with WebGL, or as a density image from
+        bokeh_helpers.DENSITY_MIN_POINTS samples on.
+        @see bokeh_helpers.scatter()
 
         Parameters
         ----------
@@ -137,34 +215,37 @@ class _ICAPlotter():
         -------
 
         """
-        ax.scatter('x', 'y', radius=0.1,
-                   fill_color='fill_color', fill_alpha=0.6,
-                   line_color=None, source=self.source)
+        self._density = bh.scatter(
+            ax, self.source, ch.palette(self.cmap), radius=0.1
+        )
+
     def set_color(self, gene_id):
         """
-        Updates self.ColumnDataSource 'fill_color' column to interactively
-        change point colors.
+        Updates self.ColumnDataSource 'color_code' column to interactively
+        change point colors. Genes in the experiment's color index are
+        looked up directly. @see Experiment.index_gene_colors()
 
         Parameters
         ----------
-        colors : pandas.DataFrame
-            Table describing samples as row indices, 'condition' and
-            corresponding 'color' as columns
+        gene_id : basestring
+            gene whose expression colors the points
 
         Returns
         -------
 
         """
-        self.expt.recolor(gene_id)
-        self.expt.metadata['hex'] = ch.expr_series_to_hex(
-            self.expt.metadata['color'],
-            self.cmap,
-            is_norm=True
-        )
-
-        self.source.data['fill_color'] = self.expt.metadata['hex']
+        codes = self.expt.gene_codes(gene_id)
+        if codes is not None:
+            # indexed gene @see Experiment.index_gene_colors()
+            self.expt.gene_of_interest = gene_id
+        else:
+            self.expt.recolor(gene_id)
+            codes = self._color_codes()
+        self.source.data['color_code'] = codes
+        if self._density is not None:
+            self._density.update(codes)
 
-    def plot(self, bokeh=False, ax=None):
+    def plot(self, bokeh=False, ax=None, rasterized=False):
         """
 
         Parameters
@@ -172,6 +253,8 @@ class _ICAPlotter():
         bokeh : Boolean
             True if plotting bokeh figure, else matplotlib axes
         ax : matplotlib.axes._subplots.AxesSubplot or bokeh.plotting.figure.Figure
+        rasterized : Boolean
+            rasterize the matplotlib points (for large pdf/svg outputs)
 
         Returns
         -------
@@ -180,12 +263,13 @@ class _ICAPlotter():
         if bokeh:
             self._bokeh(ax)
         else:
-            self._matplotlib(ax)
+            self._matplotlib(ax, rasterized=rasterized)
 
     def update_cmap(self):
         pass
 
-def icaplot(expt, cmap, ax=None, bokeh=False):
+def icaplot(expt, cmap, ax=None, bokeh=False, rasterized=False,
+            n_components=None):
     """
 
     Parameters
@@ -197,12 +281,16 @@ def icaplot(expt, cmap, ax=None, bokeh=False):
     ax : matplotlib.axes._subplots.AxesSubplot or bokeh.plotting.figure.Figure
     bokeh : Boolean
         True if plotting bokeh figure, else matplotlib axes
+    rasterized : Boolean
+        rasterize the matplotlib points (for large pdf/svg outputs)
+    n_components : int
+        principal components to unmix (@see _ICAPlotter)
 
     Returns
     -------
     _PCAPlotter object
 
     """
-    plotter = _ICAPlotter(expt, cmap)
-    plotter.plot(bokeh=bokeh, ax=ax)
+    plotter = _ICAPlotter(expt, cmap, n_components=n_components)
+    plotter.plot(bokeh=bokeh, ax=ax, rasterized=rasterized)
     return plotter
\ No newline at end of file
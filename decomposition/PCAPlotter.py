@@ -3,10 +3,10 @@ import matplotlib
 matplotlib.use('Agg')
 import pandas as pd
 import matplotlib.pyplot as plt
-from sklearn.decomposition import PCA
-from bokeh.models import ColumnDataSource
-import seaborn as sns
+import bokeh_helpers as bh
 import color_helpers as ch
+import component_helpers as cph
+import matplotlib_helpers as mh
 import numpy as np
 import pandas as pd
 
@@ -15,10 +15,15 @@ __version__ = 0.1
 __date__ = '2015-12-19'
 __updated__ = '2015-12-19'
 
+# @see component_helpers.pca_params()
+RANDOMIZED_MIN_SIZE = cph.RANDOMIZED_MIN_SIZE
+RANDOMIZED_N_COMPONENTS = cph.RANDOMIZED_N_COMPONENTS
 
-class _PCAPlotter():
 
-    def __init__(self, expt, cmap = 'Purples'):
+class _PCAPlotter(object):
+
+    def __init__(self, expt, cmap = 'Purples',
+                 n_components = None, svd_solver = None, batch_size = None):
         """
 
         Parameters
@@ -27,6 +32,19 @@ class _PCAPlotter():
             A table of gene expression in the format (genes, samples)
         cmap : matplotlib.colors.Colormap
             colormap instance corresponding to the name
+        n_components : int
+            number of principal components to keep
+            @see PCA(n_components)
+        svd_solver : basestring
+            'full', 'randomized', 'arpack' or 'auto'. If None, uses
+            'randomized' for matrices larger than RANDOMIZED_MIN_SIZE,
+            'full' otherwise. Sparse tables are decomposed with
+            TruncatedSVD, which only supports 'randomized' and 'arpack'.
+            'incremental' streams samples through an IncrementalPCA
+            instead of holding the whole matrix in memory.
+            @see PCA(svd_solver)
+        batch_size : int
+            samples per batch of the 'incremental' solver
 
         Attributes
         ----------
@@ -41,49 +59,84 @@ class _PCAPlotter():
         self.source : bokeh.models.ColumnDataSource
 
         """
+        self.n_components = n_components
+        self.svd_solver = svd_solver
+        self.batch_size = batch_size
         self.cmap = plt.get_cmap(cmap)
         self.expt = expt
         self.pca, self.prcomp = self._fit_transform()
-        self.source = self._columnsource()
+        self._source = None
+        self._density = None
+
+    @property
+    def source(self):
+        """
+        bokeh.models.ColumnDataSource of the plotted points, built (and
+        bokeh imported) the first time it is used. @see _columnsource()
+        """
+        if self._source is None:
+            self._source = self._columnsource()
+        return self._source
 
-    def get_pc_components(self):
+    def get_pc_components(self, n_components=None, n_features=None):
         """
         Returns a DataFrame of how much each feature contributes to the PC.
 
+        Parameters
+        ----------
+        n_components : int
+            only return the first n_components PCs (all if None)
+        n_features : int
+            only return features in the top n_features of any returned PC
+            (all if None)
+
         Returns
         -------
         pc_components : pandas.DataFrame
 
         """
-        pc_cols = range(len(self.pca.components_))
-        pc_components = pd.DataFrame(
-            index=self.expt.counts.data.index,
-            columns=pc_cols
+        return cph.components_to_loadings(
+            self.pca.components_,
+            self.expt.counts.index,
+            n_components=n_components,
+            n_features=n_features
         )
 
-        for n in range(0, len(self.pca.components_)):
-            for i, j in zip(
-                    self.expt.counts.data.index,
-                    np.abs(self.pca.components_[n])
-            ):
-                pc_components.ix[i, n] = j
-        return pc_components
+    def projection(self):
+        """
+        Returns the fit as a linear map of the expression of the genes in
+        self.expt.counts.index: prcomp = dot(values - mean, components.T),
+        samples as rows. @see projection.ProjectionModel
+
+        Returns
+        -------
+        mean : numpy.ndarray
+            (features,) subtracted first (zeros for the uncentered
+            TruncatedSVD of sparse tables)
+        components : numpy.ndarray
+            (components, features)
+        """
+        components = self.pca.components_
+        mean = getattr(self.pca, 'mean_', None)
+        if mean is None:
+            mean = np.zeros(components.shape[1])
+        return mean, components
 
     def _fit_transform(self):
         """
-        Transforms the expression data to principal component space.
+        Transforms the expression data to principal component space. The
+        fit is shared with any other plotter of the same experiment.
+        @see Experiment.pca()
 
         Returns
         -------
+        pca : sklearn.decomposition.PCA or TruncatedSVD
         prcomp : pandas.DataFrame
             table containing principle components ordered by variance
         """
-
-        smusher = PCA()
-        prcomp = smusher.fit_transform(self.expt.counts.data.T)
-        prcomp = pd.DataFrame(prcomp, index=self.expt.counts.data.columns)
-
-        return smusher, prcomp
+        return self.expt.pca(
+            self.n_components, self.svd_solver, self.batch_size
+        )
 
     def _columnsource(self):
         """
@@ -95,48 +148,58 @@ class _PCAPlotter():
             Object which allows set_color() method to
             interactively update colors in bokeh.
         """
-        self.expt.metadata['hex'] = ch.expr_series_to_hex(
-            self.expt.metadata['color'],
-            self.cmap,
-            is_norm=True
+        return bh.columnsource(
+            self.prcomp[0],
+            self.prcomp[1],
+            self.prcomp.index,
+            self._color_codes()
         )
 
-        return ColumnDataSource(
-            data=dict(
-                x=self.prcomp[0],
-                y=self.prcomp[1],
-                idx=self.prcomp.index,
-                fill_color=self.expt.metadata['hex'],
-            )
+    def _color_codes(self):
+        """
+        Returns the palette code of each plotted sample from the metadata
+        colors. @see color_helpers.expr_series_to_codes()
+
+        Returns
+        -------
+        numpy.ndarray of uint8
+        """
+        return ch.expr_series_to_codes(
+            self.expt.metadata['color'].reindex(self.prcomp.index),
+            is_norm=True
         )
 
-    def _matplotlib(self, ax=None):
+    def _matplotlib(self, ax=None, rasterized=False):
         """
+        Draws all samples with one scatter call. @see matplotlib_helpers
 
         Parameters
         ----------
         ax : matplotlib.axes._subplots.AxesSubplot
             subplot axes
+        rasterized : Boolean
+            draw the points as one image in vector (pdf, svg) output
 
         Returns
         -------
 
         """
+        import seaborn as sns
+
         if ax is None:
             ax = plt.gca()
 
-        colors = sns.color_palette(
-            "hls", len(set(self.expt.metadata['color']))
-        )
-        i = 0
-        for c in set(self.expt.metadata['condition']):
-
-            indices = self.prcomp.ix[self.expt.metadata[self.expt.metadata['condition'] == c].index]
-            ax.scatter(indices[0], indices[1], label=c, color=colors[i])
-            i += 1
+        metadata = self.expt.metadata.reindex(self.prcomp.index)
+        codes, conditions = pd.factorize(metadata['condition'])
+        colors = np.asarray(sns.color_palette("hls", len(conditions)))
+        mh.scatter(ax, self.prcomp, metadata['condition'], colors[codes],
+                   rasterized=rasterized)
 
     def _bokeh(self, ax):
         """
+        Draws the samples with WebGL, or as a density image from
+        bokeh_helpers.DENSITY_MIN_POINTS samples on.
+        @see bokeh_helpers.scatter()
 
         Parameters
         ----------
@@ -146,35 +209,38 @@ class _PCAPlotter():
         -------
 
         """
-        ax.scatter('x', 'y', radius=0.2,
-                   fill_color='fill_color', fill_alpha=0.6,
-                   line_color=None, source=self.source)
+        self._density = bh.scatter(
+            ax, self.source, ch.palette(self.cmap), radius=0.2
+        )
 
     def set_color(self, gene_id):
         """
-        Updates self.ColumnDataSource 'fill_color' column to interactively
-        change point colors.
+        Updates self.ColumnDataSource 'color_code' column to interactively
+        change point colors. Genes in the experiment's color index are
+        looked up directly. @see Experiment.index_gene_colors()
 
         Parameters
         ----------
-        colors : pandas.DataFrame
-            Table describing samples as row indices, 'condition' and
-            corresponding 'color' as columns
+        gene_id : basestring
+            gene whose expression colors the points
 
         Returns
         -------
 
         """
-        print('setting color')
-        self.expt.recolor(gene_id)
-        self.expt.metadata['hex'] = ch.expr_series_to_hex(
-            self.expt.metadata['color'],
-            self.cmap,
-            is_norm=True
-        )
-        self.source.data['fill_color'] = self.expt.metadata['hex']
-
-    def plot(self, bokeh=False, ax=None):
+        codes = self.expt.gene_codes(gene_id)
+        if codes is not None:
+            # indexed gene @see Experiment.index_gene_colors()
+            self.expt.gene_of_interest = gene_id
+        else:
+            print('setting color')
+            self.expt.recolor(gene_id)
+            codes = self._color_codes()
+        self.source.data['color_code'] = codes
+        if self._density is not None:
+            self._density.update(codes)
+
+    def plot(self, bokeh=False, ax=None, rasterized=False):
         """
 
         Parameters
@@ -182,6 +248,8 @@ class _PCAPlotter():
         bokeh : Boolean
             True if plotting bokeh figure, else matplotlib axes
         ax : matplotlib.axes._subplots.AxesSubplot or bokeh.plotting.figure.Figure
+        rasterized : Boolean
+            rasterize the matplotlib points (for large pdf/svg outputs)
 
         Returns
         -------
@@ -190,13 +258,15 @@ class _PCAPlotter():
         if bokeh:
             self._bokeh(ax)
         else:
-            self._matplotlib(ax)
+            self._matplotlib(ax, rasterized=rasterized)
 
     def update_cmap(self):
         pass
 
 
-def pcaplot(expt, cmap, ax=None, bokeh=False):
+def pcaplot(expt, cmap, ax=None, bokeh=False,
+            n_components=None, svd_solver=None, batch_size=None,
+            rasterized=False):
     """
 
     Parameters
@@ -208,12 +278,21 @@ def pcaplot(expt, cmap, ax=None, bokeh=False):
     ax : matplotlib.axes._subplots.AxesSubplot or bokeh.plotting.figure.Figure
     bokeh : Boolean
         True if plotting bokeh figure, else matplotlib axes
+    n_components : int
+        number of principal components to keep
+    svd_solver : basestring
+        'full', 'randomized', 'arpack', 'auto' or 'incremental' (chosen by
+        size if None)
+    batch_size : int
+        samples per batch of the 'incremental' solver
+    rasterized : Boolean
+        rasterize the matplotlib points (for large pdf/svg outputs)
 
     Returns
     -------
     _PCAPlotter object
 
     """
-    plotter = _PCAPlotter(expt, cmap)
-    plotter.plot(bokeh=bokeh, ax=ax)
+    plotter = _PCAPlotter(expt, cmap, n_components, svd_solver, batch_size)
+    plotter.plot(bokeh=bokeh, ax=ax, rasterized=rasterized)
     return plotter
\ No newline at end of file
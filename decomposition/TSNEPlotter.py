@@ -1,23 +1,32 @@
 import matplotlib
 
 matplotlib.use('Agg')
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from sklearn.manifold import TSNE
-from bokeh.models import ColumnDataSource
 
+import bokeh_helpers as bh
 import color_helpers as ch
+import matplotlib_helpers as mh
 
 __all__ = []
 __version__ = 0.1
 __date__ = '2017-2-13'
 __updated__ = '2017-2-13'
 
+# at or above this many samples, method='auto' uses the O(N log N)
+# Barnes-Hut approximation rather than exact O(N^2) gradients.
+BARNES_HUT_MIN_SAMPLES = 2000
+# number of principal components t-SNE is run on when pre-reducing.
+PCA_N_COMPONENTS = 50
 
-class _TSNEPlotter():
+
+class _TSNEPlotter(object):
 
     def __init__(self, expt, cmap = 'Purples',
-                 method = 'exact', random_state = 1):
+                 method = 'auto', random_state = 1, perplexity = 30.0,
+                 n_iter = 1000, pca_components = None,
+                 incremental = False, batch_size = None):
         """
 
         Parameters
@@ -25,38 +34,155 @@ class _TSNEPlotter():
         expt : Experiment
         cmap : basestring
         method : basestring
-            gradient calculation algorithm
+            gradient calculation algorithm, 'exact', 'barnes_hut' or
+            'auto' (barnes_hut from BARNES_HUT_MIN_SAMPLES samples on)
             @see TSNE(method)
         random_state : int
             tsne random state for tsne seed generator
             @see TSNE(random_state)
+        perplexity : float
+            effective number of neighbors, lowered to (samples - 1) / 3 if
+            it is not below the number of samples. @see TSNE(perplexity)
+        n_iter : int
+            maximum number of optimization iterations
+            @see TSNE(n_iter) (max_iter in newer sklearn)
+        pca_components : int
+            run t-SNE on this many principal components rather than on
+            all features. If None, PCA_N_COMPONENTS are used with
+            barnes_hut, none with exact; 0 disables the reduction.
+        incremental : Boolean
+            pre-reduce with the experiment's out-of-core IncrementalPCA
+            (@see component_helpers.fit_incremental_pca()), and always
+            pre-reduce, as the features are never densified
+        batch_size : int
+            samples per batch of the incremental PCA
         """
         self.method = method
         self.random_state = random_state
+        self.perplexity = perplexity
+        self.n_iter = n_iter
+        self.pca_components = pca_components
+        self.incremental = incremental
+        self.batch_size = batch_size
         self.cmap = plt.get_cmap(cmap)
         self.expt = expt
         self.tcomp = self._fit_transform()
-        self.source = self._columnsource()
-
+        self._source = None
+        self._density = None
 
+    @property
+    def source(self):
+        """
+        bokeh.models.ColumnDataSource of the plotted points, built (and
+        bokeh imported) the first time it is used. @see _columnsource()
+        """
+        if self._source is None:
+            self._source = self._columnsource()
+        return self._source
 
     def _fit_transform(self):
         """
-        Transforms the expression data to principal component space.
+        Embeds the samples in two dimensions, starting from (and if
+        pre-reducing, running on) the experiment's shared PCA rather than
+        fitting another one. @see Experiment.pca()
 
         Returns
         -------
-        prcomp : pandas.DataFrame
-            table containing principle components ordered by variance
+        tcomp : pandas.DataFrame
+            table containing the (samples, 2) embedding
         """
+        from sklearn.manifold import TSNE
+
+        n_samples = self.expt.counts.shape[1]
+        method, perplexity, pca_components = self._tsne_params(n_samples)
 
-        manifolder = TSNE(method=self.method, random_state = self.random_state)
-        tcomp = manifolder.fit_transform(self.expt.counts.data.T)
-        tcomp = pd.DataFrame(tcomp, index=self.expt.counts.data.columns)
+        prcomp = self._principal_components(pca_components)
+        if pca_components:
+            matrix = prcomp[:, :pca_components]
+        else:
+            matrix = self.expt.counts.samples_by_features(dense=True)
+
+        params = dict(
+            method=method,
+            perplexity=perplexity,
+            random_state=self.random_state
+        )
+        if prcomp.shape[1] >= 2:
+            # the same start as init='pca', without another fit
+            params['init'] = prcomp[:, :2] / np.std(prcomp[:, 0]) * 1e-4
+        try:
+            manifolder = TSNE(max_iter=self.n_iter, **params)
+        except TypeError:
+            # sklearn < 1.5
+            manifolder = TSNE(n_iter=self.n_iter, **params)
+        tcomp = manifolder.fit_transform(matrix)
+        tcomp = pd.DataFrame(tcomp, index=self.expt.counts.columns)
         return tcomp
 
+    def _tsne_params(self, n_samples):
+        """
+        Resolves the gradient method, perplexity and PCA pre-reduction for
+        a matrix of n_samples samples.
+
+        Returns
+        -------
+        method : basestring
+        perplexity : float
+        pca_components : int
+            0 if the features are used as they are
+        """
+        method = self.method
+        if method == 'auto':
+            if n_samples >= BARNES_HUT_MIN_SAMPLES:
+                method = 'barnes_hut'
+            else:
+                method = 'exact'
+
+        perplexity = self.perplexity
+        if perplexity >= n_samples:
+            perplexity = max((n_samples - 1) / 3.0, 1.0)
+            print("warning, perplexity lowered to {} for {} samples".format(
+                perplexity, n_samples
+            ))
+
+        pca_components = self.pca_components
+        if pca_components is None:
+            pca_components = PCA_N_COMPONENTS if (
+                method == 'barnes_hut' or self.incremental
+            ) else 0
+        if self.incremental:
+            # at most what an incremental fit of the matrix can have
+            pca_components = max(
+                min(pca_components, min(self.expt.counts.shape) - 1), 1
+            )
+        elif pca_components >= min(self.expt.counts.shape):
+            # nothing to reduce
+            pca_components = 0
+        return method, perplexity, pca_components
+
+    def _principal_components(self, n_components):
+        """
+        Returns the scores of the experiment's PCA (uncentered, via
+        TruncatedSVD, for sparse tables, or the IncrementalPCA if
+        incremental), refitting only if the shared fit has fewer than
+        n_components components.
+
+        Returns
+        -------
+        numpy.ndarray
+            (samples, components)
+        """
+        svd_solver = 'incremental' if self.incremental else None
+        prcomp = self.expt.pca(None, svd_solver, self.batch_size)[1]
+        if prcomp.shape[1] < n_components:
+            prcomp = self.expt.pca(
+                n_components, svd_solver, self.batch_size
+            )[1]
+        return prcomp.values
+
     def _columnsource(self):
         """
+        Creates and returns the ColumnDataSource object needed by Bokeh plots.
 
         Returns
         -------
@@ -64,28 +190,37 @@ class _TSNEPlotter():
             Object which allows set_color() method to
             interactively update colors in bokeh.
         """
+        return bh.columnsource(
+            self.tcomp[0],
+            self.tcomp[1],
+            self.tcomp.index,
+            self._color_codes()
+        )
+
+    def _color_codes(self):
+        """
+        Returns the palette code of each plotted sample from the metadata
+        colors. @see color_helpers.expr_series_to_codes()
 
-        self.expt.metadata['hex'] = ch.expr_series_to_hex(
-            self.expt.metadata['color'],
-            self.cmap,
+        Returns
+        -------
+        numpy.ndarray of uint8
+        """
+        return ch.expr_series_to_codes(
+            self.expt.metadata['color'].reindex(self.tcomp.index),
             is_norm=True
         )
-        return ColumnDataSource(
-            data=dict(
-                x=self.tcomp[0],
-                y=self.tcomp[1],
-                idx=self.tcomp.index,
-                fill_color=self.expt.metadata['hex'],
-            )
-        )
 
-    def _matplotlib(self, ax=None):
+    def _matplotlib(self, ax=None, rasterized=False):
         """
+        Draws all samples with one scatter call. @see matplotlib_helpers
 
         Parameters
         ----------
         ax : matplotlib.axes._subplots.AxesSubplot
             subplot axes
+        rasterized : Boolean
+            draw the points as one image in vector (pdf, svg) output
 
         Returns
         -------
@@ -94,16 +229,16 @@ class _TSNEPlotter():
         if ax is None:
             ax = plt.gca()
 
-        for c in set(self.expt.metadata['condition']):
-            indices = self.tcomp.ix[self.expt.metadata[self.expt.metadata['condition'] == c].index]
-
-            color = self.expt.metadata[self.expt.metadata['condition'] == c]['color']
-            rgbs = [self.cmap(n / self.expt.metadata['color'].max()) for n in color]
-
-            ax.scatter(indices[0], indices[1], label=c, color=rgbs)
+        metadata = self.expt.metadata.reindex(self.tcomp.index)
+        mh.scatter(ax, self.tcomp, metadata['condition'],
+                   mh.metadata_to_rgba(metadata['color'], self.cmap),
+                   rasterized=rasterized)
 
     def _bokeh(self, ax):
         """
+        Draws the samples with WebGL, or as a density image from
+        bokeh_helpers.DENSITY_MIN_POINTS samples on.
+        @see bokeh_helpers.scatter()
 
         Parameters
         ----------
@@ -113,34 +248,37 @@ class _TSNEPlotter():
         -------
 
         """
-        ax.scatter('x', 'y', radius=0.1,
-                   fill_color='fill_color', fill_alpha=0.6,
-                   line_color=None, source=self.source)
+        self._density = bh.scatter(
+            ax, self.source, ch.palette(self.cmap), radius=0.1
+        )
+
     def set_color(self, gene_id):
         """
-        Updates self.ColumnDataSource 'fill_color' column to interactively
-        change point colors.
+        Updates self.ColumnDataSource 'color_code' column to interactively
+        change point colors. Genes in the experiment's color index are
+        looked up directly. @see Experiment.index_gene_colors()
 
         Parameters
         ----------
-        colors : pandas.DataFrame
-            Table describing samples as row indices, 'condition' and
-            corresponding 'color' as columns
+        gene_id : basestring
+            gene whose expression colors the points
 
         Returns
         -------
 
         """
-        self.expt.recolor(gene_id)
-        self.expt.metadata['hex'] = ch.expr_series_to_hex(
-            self.expt.metadata['color'],
-            self.cmap,
-            is_norm=True
-        )
-
-        self.source.data['fill_color'] = self.expt.metadata['hex']
+        codes = self.expt.gene_codes(gene_id)
+        if codes is not None:
+            # indexed gene @see Experiment.index_gene_colors()
+            self.expt.gene_of_interest = gene_id
+        else:
+            self.expt.recolor(gene_id)
+            codes = self._color_codes()
+        self.source.data['color_code'] = codes
+        if self._density is not None:
+            self._density.update(codes)
 
-    def plot(self, bokeh=False, ax=None):
+    def plot(self, bokeh=False, ax=None, rasterized=False):
         """
 
         Parameters
@@ -148,6 +286,8 @@ class _TSNEPlotter():
         bokeh : Boolean
             True if plotting bokeh figure, else matplotlib axes
         ax : matplotlib.axes._subplots.AxesSubplot or bokeh.plotting.figure.Figure
+        rasterized : Boolean
+            rasterize the matplotlib points (for large pdf/svg outputs)
 
         Returns
         -------
@@ -156,12 +296,15 @@ class _TSNEPlotter():
         if bokeh:
             self._bokeh(ax)
         else:
-            self._matplotlib(ax)
+            self._matplotlib(ax, rasterized=rasterized)
 
     def update_cmap(self):
         pass
 
-def tsneplot(expt, cmap, ax=None, bokeh=False):
+
+def tsneplot(expt, cmap, ax=None, bokeh=False, method='auto',
+             perplexity=30.0, n_iter=1000, pca_components=None,
+             rasterized=False):
     """
 
     Parameters
@@ -173,12 +316,23 @@ def tsneplot(expt, cmap, ax=None, bokeh=False):
     ax : matplotlib.axes._subplots.AxesSubplot or bokeh.plotting.figure.Figure
     bokeh : Boolean
         True if plotting bokeh figure, else matplotlib axes
+    method : basestring
+        'exact', 'barnes_hut' or 'auto' (chosen by sample count)
+    perplexity : float
+    n_iter : int
+    pca_components : int
+        principal components to embed (@see _TSNEPlotter)
+    rasterized : Boolean
+        rasterize the matplotlib points (for large pdf/svg outputs)
 
     Returns
     -------
     _PCAPlotter object
 
     """
-    plotter = _TSNEPlotter(expt, cmap)
-    plotter.plot(bokeh=bokeh, ax=ax)
+    plotter = _TSNEPlotter(
+        expt, cmap, method=method, perplexity=perplexity, n_iter=n_iter,
+        pca_components=pca_components
+    )
+    plotter.plot(bokeh=bokeh, ax=ax, rasterized=rasterized)
     return plotter
\ No newline at end of file
@@ -0,0 +1,164 @@
+import numpy as np
+
+# samples from which a bokeh scatter is drawn as one density image instead
+# of one glyph per sample.
+DENSITY_MIN_POINTS = 50000
+# bins along each axis of the density image.
+DENSITY_BINS = 400
+
+
+def columnsource(x, y, idx, codes):
+    """
+    Creates the ColumnDataSource of a scatter. Colors are sent as uint8
+    codes into a palette (@see color_helpers.expr_series_to_codes()), which
+    bokeh transmits as one typed array rather than a list of hex strings.
+
+    Parameters
+    ----------
+    x : pandas.Series
+    y : pandas.Series
+    idx : pandas.Index
+        sample names
+    codes : numpy.ndarray
+        uint8 color code of each sample
+
+    Returns
+    -------
+    bokeh.models.ColumnDataSource
+    """
+    from bokeh.models import ColumnDataSource
+
+    return ColumnDataSource(
+        data=dict(
+            x=np.asarray(x),
+            y=np.asarray(y),
+            idx=list(idx),
+            color_code=np.asarray(codes, dtype=np.uint8),
+        )
+    )
+
+
+def scatter(ax, source, palette, radius, density_min_points=None,
+            bins=DENSITY_BINS):
+    """
+    Draws the points of source on ax with the WebGL backend. From
+    density_min_points samples on, the points are binned here and drawn as
+    one density image instead. @see DensityImage
+
+    Parameters
+    ----------
+    ax : bokeh.plotting.figure.Figure
+    source : bokeh.models.ColumnDataSource
+        @see columnsource()
+    palette : list
+        html hex color of each code
+    radius : float
+    density_min_points : int
+        DENSITY_MIN_POINTS if None
+    bins : int
+
+    Returns
+    -------
+    DensityImage or None
+        the image to update on recoloring, None if points were drawn
+    """
+    from bokeh.models import LinearColorMapper
+
+    ax.output_backend = 'webgl'
+    if density_min_points is None:
+        density_min_points = DENSITY_MIN_POINTS
+    if len(source.data['x']) < density_min_points:
+        mapper = LinearColorMapper(
+            palette=palette, low=0, high=len(palette) - 1,
+            nan_color=(0, 0, 0, 0)
+        )
+        ax.circle('x', 'y', radius=radius,
+                  fill_color={'field': 'color_code', 'transform': mapper},
+                  fill_alpha=0.6, line_color=None, source=source)
+        return None
+
+    density = DensityImage(source.data['x'], source.data['y'], palette, bins)
+    density.update(source.data['color_code'])
+    ax.image_rgba(image='image', x='x', y='y', dw='dw', dh='dh',
+                  source=density.source)
+    return density
+
+
+class DensityImage(object):
+    """
+    Server-side rasterization of a scatter: the opacity of each bin is the
+    log of the number of points in it, its color that of the most common
+    color code among them (codes index a palette, averaging them would
+    make up colors no point has). Every point is assigned to a bin once,
+    so recoloring only recounts the codes per bin.
+    """
+    def __init__(self, x, y, palette, bins=DENSITY_BINS):
+        """
+
+        Parameters
+        ----------
+        x : numpy.ndarray
+        y : numpy.ndarray
+        palette : list
+            html hex color of each code
+        bins : int
+
+        Attributes
+        ----------
+        self.source : bokeh.models.ColumnDataSource
+            image and its extent, @see bokeh.plotting.figure.Figure.image()
+        """
+        from bokeh.models import ColumnDataSource
+
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        _, xedges, yedges = np.histogram2d(x, y, bins=bins)
+        xbin = np.clip(np.searchsorted(xedges, x, 'right') - 1, 0, bins - 1)
+        ybin = np.clip(np.searchsorted(yedges, y, 'right') - 1, 0, bins - 1)
+
+        self.bins = bins
+        # images are indexed (row=y, column=x)
+        self.flat = ybin * bins + xbin
+        self.counts = np.bincount(self.flat, minlength=bins * bins)
+        self.alpha = np.round(
+            255 * np.log1p(self.counts) / np.log1p(max(self.counts.max(), 1))
+        ).astype(np.uint8)
+        self.rgb = np.array([
+            [int(color[i:i + 2], 16) for i in (1, 3, 5)] for color in palette
+        ], dtype=np.uint8)
+        self.source = ColumnDataSource(
+            data=dict(
+                image=[np.zeros((bins, bins), dtype=np.uint32)],
+                x=[xedges[0]], y=[yedges[0]],
+                dw=[xedges[-1] - xedges[0]], dh=[yedges[-1] - yedges[0]],
+            )
+        )
+
+    def update(self, codes):
+        """
+        Recolors the image with the most common code of the points in each
+        bin (the highest code on ties). Empty bins are transparent.
+
+        Parameters
+        ----------
+        codes : numpy.ndarray
+            uint8 color code of each point
+        """
+        n_codes = len(self.rgb)
+        # count each (bin, code) pair, then keep the largest count per bin
+        pairs, pair_counts = np.unique(
+            self.flat.astype(np.int64) * n_codes + np.asarray(codes),
+            return_counts=True
+        )
+        order = np.lexsort((pair_counts, pairs // n_codes))
+        pairs = pairs[order]
+        last = np.append(pairs[1:] // n_codes != pairs[:-1] // n_codes, True)
+        mode = np.zeros(self.bins * self.bins, dtype=np.int64)
+        mode[pairs[last] // n_codes] = pairs[last] % n_codes
+
+        rgba = np.empty((self.bins * self.bins, 4), dtype=np.uint8)
+        rgba[:, :3] = self.rgb[mode]
+        rgba[:, 3] = self.alpha
+        self.source.data['image'] = [
+            rgba.view(np.uint32).reshape(self.bins, self.bins)
+        ]
@@ -1,7 +1,13 @@
 import random
 
+import numpy as np
+import pandas as pd
 from matplotlib.colors import ListedColormap
 
+# expression levels kept per gene by GeneColorIndex (fits in uint8, and
+# matches the lookup table size of the named matplotlib colormaps).
+COLOR_INDEX_LEVELS = 256
+
 
 def hex_to_cmap(num_to_generate):
     hexes = generate_hex(num_to_generate)
@@ -20,8 +26,31 @@ def float_to_hex(c, cmap):
     hex string
 
     """
-    c = cmap(c)
-    return '#%02x%02x%02x' % (c[0] * 255, c[1] * 255, c[2] * 255)
+    return bytes_to_hex(cmap([c], bytes=True))[0]
+
+
+def bytes_to_hex(rgb):
+    """
+    Converts an array of 8-bit colors to html hex codes in one pass. Only
+    the distinct colors are formatted, so the cost is independent of the
+    number of points.
+
+    Parameters
+    ----------
+    rgb : numpy.ndarray
+        (N, 3) or (N, 4) array of uint8 RGB(A) values, ie. the output of
+        cmap(values, bytes=True). Alpha is ignored.
+
+    Returns
+    -------
+    numpy.ndarray of N html hex strings
+    """
+    rgb = np.asarray(rgb, dtype=np.uint32)
+    rgb = rgb.reshape(-1, rgb.shape[-1])
+    packed = (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+    unique, inverse = np.unique(packed, return_inverse=True)
+    hexes = np.array(['#%06x' % p for p in unique], dtype=object)
+    return hexes[inverse.ravel()]
 
 def generate_hex(num_to_generate):
     """
@@ -58,10 +87,10 @@ def rgb_to_hex(rgb):
     -------
     list of html hex values
     """
-    hexcolors = [
-        '#%02x%02x%02x' % (c[0] * 255, c[1] * 255, c[2] * 255) for c in rgb
-        ]
-    return hexcolors
+    rgb = np.asarray(rgb, dtype=float)
+    if len(rgb) == 0:
+        return []
+    return list(bytes_to_hex((rgb[:, :3] * 255).astype(np.uint8)))
 
 
 def expr_to_hex(expr, cmap='Purples', is_norm=True):
@@ -81,8 +110,7 @@ def expr_to_hex(expr, cmap='Purples', is_norm=True):
     -------
     list of hex corresponding to expression values
     """
-    rgbs = expr_to_rgb(expr, cmap, is_norm)
-    return rgb_to_hex(rgbs)
+    return list(bytes_to_hex(cmap(_normalize(expr, is_norm), bytes=True)))
 
 
 def expr_series_to_hex(expr, cmap='Purples', is_norm=True):
@@ -106,11 +134,76 @@ def expr_series_to_hex(expr, cmap='Purples', is_norm=True):
         normed = expr / expr.max()
     else:
         normed = expr
-    normed = normed - 0.1
-    return normed.apply(
-        lambda x: float_to_hex(x, cmap)
+    normed = np.asarray(normed, dtype=float) - 0.1
+    return pd.Series(
+        bytes_to_hex(cmap(normed, bytes=True)),
+        index=expr.index,
+        name=expr.name
     )
 
+
+def expr_series_to_codes(expr, is_norm=True, n_levels=COLOR_INDEX_LEVELS):
+    """
+    Same colors as expr_series_to_hex(), as uint8 codes into
+    palette(cmap, n_levels) rather than hex strings, so they can be shipped
+    (ie. to bokeh) as one compact typed array.
+
+    Parameters
+    ----------
+    expr : pandas.Series or numpy.ndarray
+    is_norm : normalize 0 to 1
+    n_levels : int
+        number of palette colors (at most 256)
+
+    Returns
+    -------
+    numpy.ndarray of uint8
+    """
+    expr = np.asarray(expr, dtype=float)
+    if is_norm:
+        expr = expr + 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            expr = expr / np.nanmax(expr, axis=-1)[..., np.newaxis]
+    return quantize(expr - 0.1, n_levels)
+
+
+def quantize(normed, n_levels=COLOR_INDEX_LEVELS):
+    """
+    Maps values in [0, 1] to uint8 palette codes the way a colormap picks
+    its lookup table entry (values outside are clipped, NaN maps to 0).
+
+    Parameters
+    ----------
+    normed : numpy.ndarray
+    n_levels : int
+
+    Returns
+    -------
+    numpy.ndarray of uint8
+    """
+    normed = np.nan_to_num(np.clip(normed, 0, 1))
+    return np.minimum(
+        (normed * n_levels).astype(int), n_levels - 1
+    ).astype(np.uint8)
+
+
+def palette(cmap, n_levels=COLOR_INDEX_LEVELS):
+    """
+    Returns the hex color of each code returned by quantize().
+
+    Parameters
+    ----------
+    cmap : matplotlib.colors.Colormap
+    n_levels : int
+
+    Returns
+    -------
+    list of n_levels html hex strings
+    """
+    levels = (np.arange(n_levels) + 0.5) / n_levels
+    return list(bytes_to_hex(cmap(levels, bytes=True)))
+
+
 def expr_to_rgb(expr, cmap='Purples', is_norm=True):
     """
     From a list of expression values, return a list of rgb values.
@@ -126,15 +219,17 @@ def expr_to_rgb(expr, cmap='Purples', is_norm=True):
 
     Returns
     -------
-    list of rgb corresponding to expression values
+    numpy.ndarray of (N, 4) rgba corresponding to expression values
     """
-    if is_norm:
-        norm = [float(i) / max(expr) for i in expr]  # normalize expr val [0-1]
-    else:
-        norm = expr
+    return cmap(_normalize(expr, is_norm))
 
-    rgbs = [cmap(color) for color in norm]  # add color
-    return rgbs
+
+def _normalize(expr, is_norm):
+    """ float array of expr, scaled to a max of 1 if is_norm """
+    norm = np.asarray(expr, dtype=float)
+    if is_norm:
+        norm = norm / norm.max()  # normalize expr val [0-1]
+    return norm
 
 
 def color_by_condition(df, col_string):
@@ -169,3 +264,104 @@ def color_by_condition(df, col_string):
         c+=1
     colormapped = df[col_string].apply(lambda x: colormap[x])
     return dict(colormapped)
+
+
+class GeneColorIndex(object):
+    """
+    Precomputed colors for a list of (marker) genes. The log2 expression of
+    each gene is normalized as in expr_series_to_hex() and quantized to
+    uint8 palette codes once, so recoloring samples by any indexed gene is
+    a single array gather instead of a metadata rebuild.
+    """
+    def __init__(self, counts, genes, n_levels=COLOR_INDEX_LEVELS):
+        """
+
+        Parameters
+        ----------
+        counts : ExpressionTable.ExpressionTable
+            (normalized) expression table, genes as rows
+        genes : list
+            gene ids to index; genes not in counts are skipped
+        n_levels : int
+            number of palette colors (at most 256)
+
+        Attributes
+        ----------
+        self.genes : pandas.Index
+            indexed gene ids
+        self.columns : pandas.Index
+            samples, in the order of counts.columns
+        self.codes : numpy.ndarray
+            (genes, samples) uint8 palette codes
+        """
+        positions = counts.index.get_indexer(pd.Index(genes).unique())
+        positions = positions[positions >= 0]
+        if counts.is_sparse:
+            values = counts.data[positions].toarray()
+        else:
+            values = counts.data.values[positions]
+
+        # same scaling as _generate_metadata_from_gene_expression() followed
+        # by expr_series_to_hex(is_norm=True)
+        self.n_levels = n_levels
+        self.genes = counts.index[positions]
+        self.columns = counts.columns
+        self.codes = expr_series_to_codes(
+            np.log2(np.asarray(values, dtype=float) + 1), n_levels=n_levels
+        )
+        self._palettes = {}
+
+    def __contains__(self, gene_id):
+        return gene_id in self.genes
+
+    def palette(self, cmap):
+        """
+        Returns the hex color of each palette code for cmap.
+
+        Parameters
+        ----------
+        cmap : matplotlib.colors.Colormap
+
+        Returns
+        -------
+        numpy.ndarray of n_levels html hex strings
+        """
+        # keyed by the colormap itself, as names are not unique (every
+        # hex_to_cmap() map has the default ListedColormap name). The cmap
+        # is kept along with its colors so its id is not reused while cached.
+        cached = self._palettes.get(id(cmap))
+        if cached is None or cached[0] is not cmap:
+            cached = cmap, np.array(
+                palette(cmap, self.n_levels), dtype=object
+            )
+            self._palettes[id(cmap)] = cached
+        return cached[1]
+
+    def to_codes(self, gene_id):
+        """
+        Returns the palette codes of every sample for one indexed gene.
+
+        Parameters
+        ----------
+        gene_id : basestring
+
+        Returns
+        -------
+        numpy.ndarray of uint8, in the order of self.columns
+        """
+        return self.codes[self.genes.get_loc(gene_id)]
+
+    def to_hex(self, gene_id, cmap):
+        """
+        Returns the hex color of every sample for one indexed gene.
+
+        Parameters
+        ----------
+        gene_id : basestring
+        cmap : matplotlib.colors.Colormap
+
+        Returns
+        -------
+        numpy.ndarray of html hex strings, in the order of self.columns
+        """
+        return self.palette(cmap)[self.to_codes(gene_id)]
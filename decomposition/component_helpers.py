@@ -0,0 +1,257 @@
+import numpy as np
+import pandas as pd
+
+# above this many (samples x features) matrix entries, default to a
+# randomized, truncated SVD rather than the full decomposition.
+RANDOMIZED_MIN_SIZE = 1000000
+# number of components kept by the randomized solver if none are specified.
+RANDOMIZED_N_COMPONENTS = 50
+# components plotted, kept even when the matrix is tiny.
+MIN_N_COMPONENTS = 2
+# samples per partial fit of the out-of-core ('incremental') solver.
+INCREMENTAL_BATCH_SIZE = 1000
+
+
+def components_to_loadings(components, index, n_components=None,
+                           n_features=None):
+    """
+    Builds a (features, components) table of absolute loadings directly
+    from a fitted estimator's components_ matrix.
+
+    Parameters
+    ----------
+    components : numpy.ndarray
+        (components, features) matrix, ie. sklearn's estimator.components_
+    index : pandas.Index
+        feature (gene) labels corresponding to the columns of components
+    n_components : int
+        only return the first n_components components (all if None)
+    n_features : int
+        only return features that rank in the top n_features (by absolute
+        loading) of at least one of the returned components (all if None)
+
+    Returns
+    -------
+    loadings : pandas.DataFrame
+        float64 table of features as rows, components as columns
+    """
+    components = np.asarray(components)
+    if n_components is not None:
+        components = components[:n_components]
+
+    loadings = pd.DataFrame(
+        np.abs(components.T).astype(np.float64),
+        index=index,
+        columns=range(components.shape[0])
+    )
+
+    if n_features is not None and n_features < loadings.shape[0]:
+        # rank features within each component, keep any that make a top-K
+        top = np.argpartition(
+            -loadings.values, n_features - 1, axis=0
+        )[:n_features]
+        keep = np.zeros(loadings.shape[0], dtype=bool)
+        keep[np.unique(top)] = True
+        loadings = loadings[keep]
+
+    return loadings
+
+
+def pca_params(shape, is_sparse, n_components=None, svd_solver=None):
+    """
+    Picks the number of components and svd solver to use. Large
+    matrices default to a randomized SVD of the leading components.
+
+    Parameters
+    ----------
+    shape : tuple
+        (features, samples) shape of the table
+    is_sparse : Boolean
+        sparse tables are decomposed with TruncatedSVD, which only
+        supports 'randomized' and 'arpack'
+    n_components : int
+    svd_solver : basestring
+        'full', 'randomized', 'arpack', 'auto', or 'incremental' to fit
+        an IncrementalPCA batch by batch (dense or sparse tables)
+
+    Returns
+    -------
+    n_components : int
+    svd_solver : basestring
+    """
+    n_features, n_samples = shape
+
+    if svd_solver == 'incremental':
+        if n_components is None:
+            n_components = min(
+                RANDOMIZED_N_COMPONENTS, n_samples - 1, n_features
+            )
+            # the plots need two, which a batch of two samples still has
+            n_components = max(
+                n_components, min(MIN_N_COMPONENTS, n_samples, n_features)
+            )
+        return n_components, svd_solver
+    if is_sparse:
+        # TruncatedSVD only supports these two
+        if svd_solver not in ('randomized', 'arpack'):
+            svd_solver = 'randomized'
+    elif svd_solver is None:
+        if n_samples * n_features >= RANDOMIZED_MIN_SIZE:
+            svd_solver = 'randomized'
+        else:
+            svd_solver = 'full'
+
+    if n_components is None and svd_solver in ('randomized', 'arpack'):
+        # arpack requires strictly fewer components than min(shape)
+        n_components = min(
+            RANDOMIZED_N_COMPONENTS,
+            min(n_samples, n_features) - 1
+        )
+        if n_components < MIN_N_COMPONENTS:
+            # too few samples (or features) for a truncated SVD to keep
+            # the two components that are plotted
+            if is_sparse:
+                svd_solver = 'randomized'
+                n_components = min(MIN_N_COMPONENTS, n_features)
+            else:
+                svd_solver = 'full'
+                n_components = None
+    return n_components, svd_solver
+
+
+def ica_pca_params(is_sparse, n_components=None, incremental=False):
+    """
+    Returns the Experiment.pca() parameters of the PCA whose scores ICA
+    whitens. By default this is the full-rank PCA, as FastICA's own
+    whitening would compute, so every component is unmixed. Given
+    n_components, only that many leading components are (the same fit as
+    a PCA plot of that many components). Sparse tables cannot be
+    decomposed to full rank without densifying them, so they are whitened
+    from a TruncatedSVD of n_components (or RANDOMIZED_N_COMPONENTS).
+    Out of core, the IncrementalPCA of n_components (or its default) is
+    whitened, as a full-rank PCA would need the matrix in memory.
+
+    Parameters
+    ----------
+    is_sparse : Boolean
+    n_components : int
+    incremental : Boolean
+        @see fit_incremental_pca()
+
+    Returns
+    -------
+    n_components : int
+    svd_solver : basestring
+        @see pca_params()
+    """
+    if incremental:
+        return n_components, 'incremental'
+    if n_components is None and not is_sparse:
+        return None, 'full'
+    return n_components, None
+
+
+def fit_pca(counts, n_components, svd_solver, batch_size=None):
+    """
+    Fits a PCA (TruncatedSVD for sparse tables, which is uncentered but
+    never densifies the matrix) to the samples of an expression table.
+
+    Parameters
+    ----------
+    counts : ExpressionTable.ExpressionTable
+    n_components : int
+    svd_solver : basestring
+        @see pca_params()
+    batch_size : int
+        samples per batch if svd_solver is 'incremental'
+        (INCREMENTAL_BATCH_SIZE if None)
+
+    Returns
+    -------
+    smusher : sklearn.decomposition.PCA, TruncatedSVD or IncrementalPCA
+    prcomp : pandas.DataFrame
+        table of (samples, components) scores
+    """
+    from sklearn.decomposition import PCA
+    from sklearn.decomposition import TruncatedSVD
+
+    if svd_solver == 'incremental':
+        return fit_incremental_pca(counts, n_components, batch_size)
+    if counts.is_sparse:
+        smusher = TruncatedSVD(
+            n_components=n_components, algorithm=svd_solver
+        )
+    else:
+        smusher = PCA(n_components=n_components, svd_solver=svd_solver)
+    prcomp = smusher.fit_transform(counts.samples_by_features())
+    return smusher, pd.DataFrame(prcomp, index=counts.columns)
+
+
+def fit_incremental_pca(counts, n_components, batch_size=None):
+    """
+    Fits an IncrementalPCA out of core: samples are streamed from the
+    table batch_size at a time (@see ExpressionTable.iter_sample_chunks),
+    once to fit and once to transform, so the full (samples, features)
+    matrix is never held in memory.
+
+    Parameters
+    ----------
+    counts : ExpressionTable.ExpressionTable
+    n_components : int
+    batch_size : int
+        INCREMENTAL_BATCH_SIZE if None (raised to n_components if smaller)
+
+    Returns
+    -------
+    smusher : sklearn.decomposition.IncrementalPCA
+    prcomp : pandas.DataFrame
+        table of (samples, components) scores
+    """
+    from sklearn.decomposition import IncrementalPCA
+
+    batch_size = max(batch_size or INCREMENTAL_BATCH_SIZE, n_components)
+    smusher = IncrementalPCA(n_components=n_components)
+
+    # every partial fit needs at least n_components samples, so a short
+    # last batch is folded into the one before it
+    pending = None
+    for batch in counts.iter_sample_chunks(batch_size):
+        if pending is not None and batch.shape[0] < n_components:
+            batch = np.vstack((pending, batch))
+        elif pending is not None:
+            smusher.partial_fit(pending)
+        pending = batch
+    smusher.partial_fit(pending)
+
+    prcomp = np.vstack([
+        smusher.transform(batch)
+        for batch in counts.iter_sample_chunks(batch_size)
+    ])
+    return smusher, pd.DataFrame(prcomp, index=counts.columns)
+
+
+def whiten(scores):
+    """
+    Scales (samples, components) scores to zero mean and unit variance,
+    ie. the whitening step of ICA, done on already computed PCs.
+
+    Parameters
+    ----------
+    scores : numpy.ndarray
+
+    Returns
+    -------
+    whitened : numpy.ndarray
+        scores of the components that carry any variance, whitened
+    keep : numpy.ndarray
+        boolean mask of those components
+    scale : numpy.ndarray
+        standard deviation of each kept component
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    scale = scores.std(axis=0, ddof=1)
+    # drop components beyond the rank of the matrix
+    keep = scale > scale.max() * np.finfo(np.float64).eps * max(scores.shape)
+    scores = scores[:, keep]
+    scale = scale[keep]
+    return (scores - scores.mean(axis=0)) / scale, keep, scale
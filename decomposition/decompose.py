@@ -3,24 +3,43 @@ import matplotlib
 matplotlib.use('Agg')
 import sys
 import os
+import csv
+import shlex
+import atexit
+import shutil
 import logging
-
-import matplotlib.pyplot as plt
+import tempfile
+import multiprocessing
 
 from argparse import ArgumentParser
 from argparse import RawDescriptionHelpFormatter
 
-from decomposition import PCAPlotter
-from decomposition import TSNEPlotter
-from decomposition import ICAPlotter
 from decomposition import color_helpers as ch
+from decomposition import component_helpers as cph
 from decomposition import Experiment
+from decomposition import projection
+from decomposition import table_cache
+from decomposition import stage_timer
+from decomposition import table_writer
 
 DEBUG = 0
 TESTRUN = 0
 PROFILE = 0
 
 SEP = "\t"
+ALGORITHMS = ('PCA', 'ICA', 'TSNE')
+# log names of the row filters in ExpressionTable.filter_log
+FILTER_SIZES = {
+    'subset': 'SUBSET SIZE',
+    'cutoff': 'CUTOFF SIZE',
+    'top_variable': 'TOP VARIABLE SIZE',
+}
+MANIFEST_COLUMNS = (
+    'input', 'conditions', 'conditions_col', 'algorithm', 'output', 'flags'
+)
+
+# temporary directories created for this process, by kind
+_TEMPORARY_DIRS = {}
 
 __all__ = []
 __version__ = 0.2
@@ -35,7 +54,38 @@ def main(argv=None):  # IGNORE:C0111
     else:
         sys.argv.extend(argv)
 
-    program_name = os.path.basename(sys.argv[0])
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        return batch(sys.argv[2:])
+
+    parser = build_parser()
+
+    # Process arguments
+    args = parser.parse_args()
+    if parse_algorithms(args.algorithm) is None:
+        print("invalid algorithm. Exiting..")
+        sys.exit(1)
+    check_args(parser, args)
+
+    # prefix
+    prefix = os.path.splitext(args.output)[0]
+
+    # Process logging info
+    logger = setup_logger('PCA_runner', prefix)
+    logger.info("starting program")
+
+    """ read in counts file """
+    logger.info(sys.argv)
+    run(args, logger)
+
+
+def build_parser():
+    """
+    Returns the ArgumentParser for a single decompose run.
+
+    Returns
+    -------
+    argparse.ArgumentParser
+    """
     program_version = "v%s" % __version__
     program_build_date = str(__updated__)
     program_version_message = '%%(prog)s %s (%s)' % (
@@ -53,13 +103,33 @@ def main(argv=None):  # IGNORE:C0111
     parser.add_argument("-i", "--input",
                         dest="input",
                         required=True,
-                        help="input matrix as featureCounts or matrix")
+                        help="input matrix as featureCounts or matrix " + \
+                             "(or a sparse .mtx/.npz matrix, or a " + \
+                             "memory-mapped .npy matrix)")
+    parser.add_argument("--row-names",
+                        dest="row_names",
+                        default=None,
+                        help="line-delimited gene ids for the rows of a " + \
+                             "sparse .mtx/.npz or .npy input (ie. genes.tsv)")
+    parser.add_argument("--col-names",
+                        dest="col_names",
+                        default=None,
+                        help="line-delimited sample ids for the columns " + \
+                             "of a sparse .mtx/.npz or .npy input " + \
+                             "(ie. barcodes.tsv)")
     parser.add_argument("-rpkm", "--rpkm",
                         dest="rpkm",
                         default=False,
                         action='store_true',
                         help="flag converts expression counts to rpkm " + \
-                             "(requires featureCounts)")
+                             "(requires featureCounts, or --lengths for " + \
+                             "a sparse .mtx/.npz input)")
+    parser.add_argument("--lengths",
+                        dest="lengths",
+                        default=None,
+                        help="tab separated gene id and length table " + \
+                             "(with a header) for -rpkm on a sparse " + \
+                             ".mtx/.npz input")
     parser.add_argument("-l2", "--log2",
                         dest="log2",
                         default=False,
@@ -84,6 +154,18 @@ def main(argv=None):  # IGNORE:C0111
                         default=None,
                         help="line-delimited file containing the genes of " + \
                              "interest")
+    parser.add_argument("--top-variable",
+                        dest="top_variable",
+                        default=None,
+                        type=int,
+                        help="only decompose the N most variable genes " + \
+                             "(after normalization)")
+    parser.add_argument("--top-variable-method",
+                        dest="top_variable_method",
+                        default='variance',
+                        choices=['variance', 'dispersion'],
+                        help="rank genes for --top-variable by variance " + \
+                             "or by variance / mean [variance]")
     parser.add_argument("-g", "--gene",
                         dest="gene_id",
                         default=None,
@@ -105,155 +187,1035 @@ def main(argv=None):  # IGNORE:C0111
                         dest="keep",
                         default=False,
                         action='store_true',
-                        help="True if we want to keep all intermediates")
+                        help="True if we want to keep all " + \
+                             "intermediates. Each is a copy of the " + \
+                             "matrix written in the background: up to " + \
+                             "1GB of copies are held (one at least, so " + \
+                             "twice the matrix for large ones), in " + \
+                             "--mmap-dir if given")
+    parser.add_argument("--intermediates-format",
+                        dest="intermediates_format",
+                        default='txt',
+                        choices=table_writer.FORMATS,
+                        help="format of the -k matrix intermediates: " + \
+                             "text, gzipped text, .npy (with .rows.txt/" + \
+                             ".cols.txt names) or parquet [txt]")
+    parser.add_argument("--float-precision",
+                        dest="float_precision",
+                        default=None,
+                        type=int,
+                        help="significant digits of floats in text " + \
+                             "intermediates (default: all)")
+    parser.add_argument("-kc", "--keep-components",
+                        dest="keep_components",
+                        default=None,
+                        type=int,
+                        help="only write the first N components to the " + \
+                             "component loadings file (-k flag must be on)")
+    parser.add_argument("-kf", "--keep-features",
+                        dest="keep_features",
+                        default=None,
+                        type=int,
+                        help="only write features ranking in the top N " + \
+                             "of any component to the component " + \
+                             "loadings file (-k flag must be on)")
+    parser.add_argument("--chunksize",
+                        dest="chunksize",
+                        default=None,
+                        type=int,
+                        help="parse featureCounts input this many rows " + \
+                             "at a time to bound memory use")
+    parser.add_argument("--dtype",
+                        dest="dtype",
+                        default=None,
+                        choices=['float32', 'float64'],
+                        help="float precision used from load through " + \
+                             "normalization and decomposition (float32 " + \
+                             "halves memory, default: as parsed)")
+    parser.add_argument("--cache-dir",
+                        dest="cache_dir",
+                        default=table_cache.default_cache_dir(),
+                        help="directory in which parsed input tables are " + \
+                             "cached for later runs, up to 20GB, least " + \
+                             "recently used first out (default: " + \
+                             "$DECOMPOSITION_CACHE_DIR, or no caching)")
+    parser.add_argument("--no-cache",
+                        dest="no_cache",
+                        default=False,
+                        action='store_true',
+                        help="flag disables the parsed input table cache")
     parser.add_argument("-a", "--algorithm",
                         dest="algorithm",
                         default='PCA',
                         type=str,
-                        help="Algorithm ([PCA] by default, or 'tSNE')")
+                        help="Algorithm ([PCA] by default, 'ICA' or " + \
+                             "'tSNE'), or a comma-separated list to run " + \
+                             "several on one load ([prefix].[algorithm]" + \
+                             "[ext] outputs)")
+    parser.add_argument("-p", "--processes",
+                        dest="processes",
+                        default=None,
+                        type=int,
+                        help="worker processes when running several " + \
+                             "algorithms (default: one per algorithm)")
+    parser.add_argument("-n", "--n-components",
+                        dest="n_components",
+                        default=None,
+                        type=int,
+                        help="number of principal components to compute " + \
+                             "(PCA only, all by default for small matrices)")
+    parser.add_argument("--svd-solver",
+                        dest="svd_solver",
+                        default=None,
+                        choices=['full', 'randomized', 'arpack', 'auto'],
+                        help="PCA svd solver (default: randomized for " + \
+                             "large matrices, full otherwise)")
+    parser.add_argument("--incremental",
+                        dest="incremental",
+                        default=False,
+                        action='store_true',
+                        help="out-of-core PCA: memory-map the cached " + \
+                             "matrix and fit an IncrementalPCA on " + \
+                             "batches of samples, which ICA and " + \
+                             "t-SNE also run on (the cache and " + \
+                             "working buffers go to temporary " + \
+                             "directories unless --cache-dir and " + \
+                             "--mmap-dir are given)")
+    parser.add_argument("--batch-size",
+                        dest="batch_size",
+                        default=None,
+                        type=int,
+                        help="samples per --incremental batch [1000]")
+    parser.add_argument("--mmap-dir",
+                        dest="mmap_dir",
+                        default=None,
+                        help="write normalized (and filtered) matrices " + \
+                             "to memory-mapped files in this directory " + \
+                             "instead of allocating them in memory")
+    parser.add_argument("--ica-components",
+                        dest="ica_components",
+                        default=None,
+                        type=int,
+                        help="ICA: unmix only this many leading " + \
+                             "principal components (default: all, as " + \
+                             "FastICA does; 50 for sparse input, which " + \
+                             "is whitened from a TruncatedSVD)")
+    parser.add_argument("--tsne-method",
+                        dest="tsne_method",
+                        default='auto',
+                        choices=['auto', 'exact', 'barnes_hut'],
+                        help="t-SNE gradient method (default: barnes_hut " + \
+                             "for 2000+ samples, exact otherwise)")
+    parser.add_argument("--perplexity",
+                        dest="perplexity",
+                        default=30.0,
+                        type=float,
+                        help="t-SNE perplexity [30]")
+    parser.add_argument("--tsne-iter",
+                        dest="tsne_iter",
+                        default=1000,
+                        type=int,
+                        help="t-SNE optimization iterations [1000]")
+    parser.add_argument("--tsne-pca",
+                        dest="tsne_pca",
+                        default=None,
+                        type=int,
+                        help="embed this many principal components rather " + \
+                             "than all features (default: 50 with " + \
+                             "barnes_hut, 0 to disable)")
+    parser.add_argument("--timing-report",
+                        dest="timing_report",
+                        default=None,
+                        help="write the wall time, cpu time and peak " + \
+                             "memory of each stage to this JSON file " + \
+                             "(stages are always logged to [prefix].log)")
+    parser.add_argument("--rasterized",
+                        dest="rasterized",
+                        default=False,
+                        action='store_true',
+                        help="draw the points as one image inside vector " + \
+                             "(pdf, svg) outputs, keeping large plots small")
+    parser.add_argument("--save-model",
+                        dest="save_model",
+                        default=False,
+                        action='store_true',
+                        help="save each PCA/ICA fit with its gene order " + \
+                             "and normalization as [prefix].pcamodel.npz " + \
+                             "/ [prefix].icamodel.npz (@see --project-onto)")
+    parser.add_argument("--project-onto",
+                        dest="project_onto",
+                        default=None,
+                        help="place the (raw count) input samples in the " + \
+                             "space of a --save-model fit instead of " + \
+                             "fitting, normalizing them as that fit did; " + \
+                             "writes [prefix].projected.txt")
+
+    return parser
+
+
+def check_args(parser, args):
+    """
+    Exits through parser.error() on options that cannot run together.
+
+    Parameters
+    ----------
+    parser : argparse.ArgumentParser
+    args : argparse.Namespace
+    """
+    is_sparse = Experiment.is_sparse_file(args.input)
+    if args.rpkm and not args.featureCounts and not (
+            is_sparse and args.lengths is not None):
+        parser.error("-rpkm needs gene lengths: featureCounts input (-f), "
+                     "or --lengths with a sparse .mtx/.npz input")
+    if args.lengths is not None and not is_sparse:
+        parser.error("--lengths is only read for sparse .mtx/.npz input")
+    if args.incremental and args.tsne_pca == 0:
+        parser.error("--incremental t-SNE runs on principal components, "
+                     "--tsne-pca 0 would need the whole matrix in memory")
+
+
+def parse_algorithms(algorithm):
+    """
+    Splits a comma-separated --algorithm value.
+
+    Parameters
+    ----------
+    algorithm : basestring
+
+    Returns
+    -------
+    list of ALGORITHMS names, or None if any name is invalid
+    """
+    algorithms = [a.strip().upper() for a in algorithm.split(',')]
+    for algorithm in algorithms:
+        if algorithm not in ALGORITHMS:
+            return None
+    return algorithms
+
+
+def setup_logger(name, prefix):
+    """
+    Returns a logger writing INFO to [prefix].log and ERROR to [prefix].err
+
+    Parameters
+    ----------
+    name : basestring
+        logger name (one per concurrent run)
+    prefix : basestring
+
+    Returns
+    -------
+    logging.Logger
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    ih = logging.FileHandler(prefix + ".log")
+    eh = logging.FileHandler(prefix + ".err")
+    ih.setLevel(logging.INFO)
+    eh.setLevel(logging.ERROR)
+    logger.addHandler(ih)
+    logger.addHandler(eh)
+    formatter = logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ih.setFormatter(formatter)
+    eh.setFormatter(formatter)
+    return logger
 
-    # Process arguments
-    args = parser.parse_args()
 
+def close_logger(logger):
+    """ removes and closes the handlers added by setup_logger() """
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def reader_dirs(args):
+    """
+    Returns the cache and mmap directories to read args.input with.
+    --incremental streams the matrix memory-mapped from the cache and
+    writes any filtered/normalized copy of it to memory-mapped files, so
+    without a --cache-dir (or with --no-cache) and --mmap-dir, temporary
+    directories (removed at exit) are used instead of reading it into
+    memory.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        @see build_parser()
+
+    Returns
+    -------
+    cache_dir : basestring
+    mmap_dir : basestring
+    """
+    cache_dir = None if args.no_cache else args.cache_dir
+    mmap_dir = args.mmap_dir
+    if args.incremental:
+        if cache_dir is None:
+            cache_dir = temporary_dir('cache')
+        if mmap_dir is None:
+            mmap_dir = temporary_dir('mmap')
+    return cache_dir, mmap_dir
+
+
+def temporary_dir(kind):
+    """
+    Returns a temporary directory (in $TMPDIR) for this process, created
+    on first use and removed at exit. Forked workers share their parent's.
+
+    Parameters
+    ----------
+    kind : basestring
+        ie. 'cache' or 'mmap'
+
+    Returns
+    -------
+    basestring
+    """
+    if kind not in _TEMPORARY_DIRS:
+        path = tempfile.mkdtemp(prefix='decompose.{}.'.format(kind))
+        atexit.register(shutil.rmtree, path, True)
+        _TEMPORARY_DIRS[kind] = path
+    return _TEMPORARY_DIRS[kind]
+
+
+def run(args, logger, counts=None):
+    """
+    Loads, normalizes, fits and plots according to parsed command line
+    arguments.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        @see build_parser()
+    logger : logging.Logger
+    counts : ExpressionTable.ExpressionTable
+        already loaded table to use instead of reading args.input
+
+    Returns
+    -------
+
+    """
     # io
     counts_file = args.input
     output_file = args.output
     subset_file = args.subset
     conditions_file = args.conditions
     conditions_col = args.conditions_col
-    algorithm = args.algorithm.upper()
+    algorithms = parse_algorithms(args.algorithm)
+    if algorithms is None:
+        raise ValueError("invalid algorithm: {}".format(args.algorithm))
 
     is_featurecounts = args.featureCounts
     is_rpkm = args.rpkm
     is_log2 = args.log2
     keep_intermediates = args.keep
+    keep_components = args.keep_components
+    keep_features = args.keep_features
+    n_components = args.n_components
+    svd_solver = 'incremental' if args.incremental else args.svd_solver
     sum_cutoff = args.cutoff
     gene_id = args.gene_id
+    cache_dir, mmap_dir = reader_dirs(args)
 
     # prefix
     prefix = os.path.splitext(output_file)[0]
 
-    # Process logging info
-    logger = logging.getLogger('PCA_runner')
-    logger.setLevel(logging.INFO)
-    ih = logging.FileHandler(prefix + ".log")
-    eh = logging.FileHandler(prefix + ".err")
-    ih.setLevel(logging.INFO)
-    eh.setLevel(logging.ERROR)
-    logger.addHandler(ih)
-    logger.addHandler(eh)
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    ih.setFormatter(formatter)
-    eh.setFormatter(formatter)
-    logger.info("starting program")
+    timer = stage_timer.StageTimer(logger)
 
-    """ read in counts file """
-    logger.info(sys.argv)
-    experiment = Experiment.Experiment(
-        counts_file=counts_file,
-        conditions_file=conditions_file,
-        conditions_col=conditions_col,
-        gene_id=gene_id,
-        is_featurecounts=is_featurecounts,
-    )
+    if args.project_onto is not None and (
+            subset_file or is_rpkm or is_log2 or sum_cutoff > 0 or
+            args.top_variable is not None):
+        print("warning, the saved model's genes and normalization are used, "
+              "-s, -rpkm, -l2, -sc and --top-variable are ignored")
+
+    with timer.stage('load'):
+        experiment = Experiment.Experiment(
+            counts_file=counts_file,
+            conditions_file=conditions_file,
+            conditions_col=conditions_col,
+            gene_id=gene_id,
+            is_featurecounts=is_featurecounts,
+            row_names_file=args.row_names,
+            col_names_file=args.col_names,
+            cache_dir=cache_dir,
+            chunksize=args.chunksize,
+            dtype=args.dtype,
+            mmap=args.incremental,
+            mmap_dir=mmap_dir,
+            lengths_file=args.lengths,
+            counts=counts,
+            # without intermediates to write, defer reading and normalizing
+            # until the plotter needs the matrix
+            lazy=not keep_intermediates,
+        )
+
+    if args.project_onto is not None:
+        """ place the samples in a saved fit without refitting """
+        logger.info("PROJECT ONTO: {}".format(args.project_onto))
+        project(experiment, args.project_onto, output_file,
+                select_cmap(experiment, conditions_file, conditions_col),
+                rasterized=args.rasterized, timer=timer)
+        if args.timing_report is not None:
+            timer.report(
+                args.timing_report,
+                input=counts_file,
+                output=output_file,
+                model=args.project_onto,
+                shape=list(experiment.counts.shape),
+            )
+        return
+
+    # intermediates are written in the background while the run goes on
+    writer = None
+    if keep_intermediates:
+        writer = table_writer.IntermediateWriter(
+            args.intermediates_format, args.float_precision, SEP
+        )
 
     """ do pca on select genes only """
     if subset_file and os.path.exists(subset_file):
         logger.info("SUBSET on: {}".format(subset_file))
-        logger.info(
-            "SUBSET SIZE (before): {}".format(
-                experiment.counts.data.shape[0]
+        if keep_intermediates:
+            logger.info(
+                "SUBSET SIZE (before): {}".format(
+                    experiment.counts.shape[0]
+                )
             )
-        )
-        experiment.counts.subset(subset_file)
+        with timer.stage('subset'):
+            experiment.counts.subset(subset_file)
+            if keep_intermediates:
+                writer.write(experiment.counts, prefix + ".subset")
         if keep_intermediates:
-            experiment.counts.data.to_csv(prefix + ".subset.txt",sep=SEP)
-        logger.info(
-            "SUBSET SIZE (after): {}".format(
-                experiment.counts.data.shape[0]
+            logger.info(
+                "SUBSET SIZE (after): {}".format(
+                    experiment.counts.shape[0]
+                )
             )
-        )
 
-    """ rpkm """
-    if is_rpkm:
-        logger.info("RPKM FLAG ON")
-        experiment.counts.as_rpkm()
-        if keep_intermediates:
-            experiment.counts.data.to_csv(prefix + ".rpkm.txt", sep=SEP)
+    if keep_intermediates:
+        """ rpkm """
+        if is_rpkm:
+            logger.info("RPKM FLAG ON")
+            with timer.stage('rpkm'):
+                experiment.counts.as_rpkm()
+                writer.write(experiment.counts, prefix + ".rpkm")
 
-    """ removes rows whos sum (reads) < cutoff """
-    if sum_cutoff > 0:
-        logger.info("CUTOFF AT {} READ ROW SUMS".format(sum_cutoff))
+        """ removes rows whos sum (reads) < cutoff """
+        if sum_cutoff > 0:
+            logger.info("CUTOFF AT {} READ ROW SUMS".format(sum_cutoff))
+            logger.info(
+                "CUTOFF SIZE (before): {}".format(
+                    experiment.counts.shape[0]
+                )
+            )
+            with timer.stage('cutoff'):
+                experiment.counts.min_row_sum_cutoff(sum_cutoff)
+                writer.write(experiment.counts, prefix + ".cutoff")
+            logger.info(
+                "CUTOFF SIZE (after): {}".format(
+                    experiment.counts.shape[0]
+                )
+            )
+
+        """ log2 """
+        if is_log2:
+            logger.info("LOG2 FLAG ON")
+            with timer.stage('log2'):
+                experiment.counts.as_log2(1)
+                writer.write(experiment.counts, prefix + ".log2")
+    else:
+        """ rpkm, cutoff and log2 in one in-place pass, run on first use """
         logger.info(
-            "CUTOFF SIZE (before): {}".format(
-                experiment.counts.data.shape[0]
+            "NORMALIZE (deferred) (rpkm: {}, cutoff: {}, log2: {})".format(
+                is_rpkm, sum_cutoff, is_log2
             )
         )
-        experiment.counts.min_row_sum_cutoff(sum_cutoff)
-        if keep_intermediates:
-            experiment.counts.data.to_csv(prefix + ".cutoff.txt", sep=SEP)
+        experiment.counts.normalize(
+            rpkm=is_rpkm,
+            min_expr_sum=sum_cutoff if sum_cutoff > 0 else None,
+            log2=is_log2,
+            pseudocount=1
+        )
+
+    """ keep the most variable genes """
+    if args.top_variable is not None:
         logger.info(
-            "CUTOFF SIZE (before): {}".format(
-                experiment.counts.data.shape[0]
+            "TOP {} VARIABLE GENES BY {}".format(
+                args.top_variable, args.top_variable_method.upper()
             )
         )
+        with timer.stage('top_variable'):
+            experiment.counts.top_variable(
+                args.top_variable, args.top_variable_method
+            )
+            if keep_intermediates:
+                writer.write(experiment.counts, prefix + ".variable")
+        if keep_intermediates:
+            logger.info(
+                "TOP VARIABLE SIZE (after): {}".format(
+                    experiment.counts.shape[0]
+                )
+            )
 
-    """ log2 """
-    if is_log2:
-        logger.info("LOG2 FLAG ON")
-        experiment.counts.as_log2(1)
+    if not keep_intermediates:
+        # the deferred read and normalization, timed on their own rather
+        # than as part of the first fit
+        with timer.stage('normalize (deferred)'):
+            experiment.counts.data
+        # the sizes logged step by step when the filters run eagerly
+        for step, before, after in experiment.counts.filter_log:
+            logger.info("{} (before): {}".format(FILTER_SIZES[step], before))
+            logger.info("{} (after): {}".format(FILTER_SIZES[step], after))
+
+    with timer.stage('metadata'):
+        """ save metadata """
         if keep_intermediates:
-            experiment.counts.data.to_csv(prefix + ".log2.txt", sep=SEP)
+            experiment.metadata.to_csv(prefix + ".metadata.txt", sep=SEP)
 
-    """ save metadata """
-    if keep_intermediates:
-        experiment.metadata.to_csv(prefix + ".metadata.txt", sep=SEP)
+        """ get appropriate cmap """
+        cmap = select_cmap(experiment, conditions_file, conditions_col)
 
-    """ get appropriate cmap """
-    if conditions_file is not None and conditions_col is not None:
-        cmap = ch.hex_to_cmap(experiment.metadata.shape[1])
+    """ plot stuff """
+    options = dict(
+        keep_intermediates=keep_intermediates,
+        keep_components=keep_components,
+        keep_features=keep_features,
+        n_components=n_components,
+        svd_solver=svd_solver,
+        batch_size=args.batch_size,
+        ica_components=args.ica_components,
+        tsne_method=args.tsne_method,
+        perplexity=args.perplexity,
+        tsne_iter=args.tsne_iter,
+        tsne_pca=args.tsne_pca,
+        rasterized=args.rasterized,
+        save_model=args.save_model,
+    )
+    if len(algorithms) == 1:
+        run_algorithm(experiment, algorithms[0], cmap, output_file,
+                      timer=timer, **options)
     else:
-        cmap = 'Purples'
+        # finish writing before forking, workers never inherit a busy writer
+        if writer is not None:
+            with timer.stage('intermediates'):
+                writer.close()
+            writer = None
+        run_algorithms(
+            experiment, algorithms, cmap, output_file, args.processes,
+            logger, timer=timer, **options
+        )
+    if writer is not None:
+        with timer.stage('intermediates'):
+            writer.close()
+    logger.info("MATRIX SIZE: {}".format(experiment.counts.shape))
+    if args.timing_report is not None:
+        timer.report(
+            args.timing_report,
+            input=counts_file,
+            output=output_file,
+            algorithms=algorithms,
+            shape=list(experiment.counts.shape),
+        )
 
-    """ plot stuff """
+
+def select_cmap(experiment, conditions_file, conditions_col):
+    """ one color per condition if given conditions, Purples otherwise """
+    if conditions_file is not None and conditions_col is not None:
+        return ch.hex_to_cmap(experiment.metadata.shape[1])
+    return 'Purples'
+
+
+def run_algorithm(experiment, algorithm, cmap, output_file,
+                  keep_intermediates=False, keep_components=None,
+                  keep_features=None, n_components=None, svd_solver=None,
+                  batch_size=None, ica_components=None, tsne_method='auto',
+                  perplexity=30.0, tsne_iter=1000, tsne_pca=None,
+                  rasterized=False, save_model=False, timer=None):
+    """
+    Fits and plots one algorithm, saving the figure to output_file and the
+    transformed coordinates (and component loadings if keep_intermediates)
+    to [prefix].*comp.txt.
+
+    Parameters
+    ----------
+    experiment : Experiment.Experiment
+    algorithm : basestring
+        one of ALGORITHMS
+    cmap : basestring or matplotlib.colors.Colormap
+    output_file : basestring
+    save_model : Boolean
+        write a PCA/ICA fit to [prefix].[algorithm]model.npz
+        @see projection.ProjectionModel
+    timer : stage_timer.StageTimer
+        records the fit, plot and save stages (not recorded if None)
+
+    Returns
+    -------
+
+    """
+    # deferred so that only the plotter (and estimator) in use is imported
+    import matplotlib.pyplot as plt
+
+    if timer is None:
+        timer = stage_timer.StageTimer()
+    prefix = os.path.splitext(output_file)[0]
     fig, ax = plt.subplots()
 
-    if algorithm == 'PCA':
-        plotter = PCAPlotter.pcaplot(
-            experiment,
-            cmap,
-            ax=ax, bokeh=False)
-        plotter.prcomp.to_csv(prefix + '.pcacomp.txt', sep=SEP)
-        if keep_intermediates:
-            plotter.get_pc_components().to_csv(
-                prefix + '.prcomp.txt', sep=SEP
+    with timer.stage(algorithm + ' fit'):
+        if algorithm == 'PCA':
+            from decomposition import PCAPlotter
+
+            plotter = PCAPlotter._PCAPlotter(
+                experiment,
+                cmap,
+                n_components=n_components,
+                svd_solver=svd_solver,
+                batch_size=batch_size)
+        elif algorithm == 'TSNE':
+            from decomposition import TSNEPlotter
+
+            plotter = TSNEPlotter._TSNEPlotter(
+                experiment,
+                cmap,
+                method=tsne_method,
+                perplexity=perplexity,
+                n_iter=tsne_iter,
+                pca_components=tsne_pca,
+                incremental=svd_solver == 'incremental',
+                batch_size=batch_size)
+        elif algorithm == 'ICA':
+            from decomposition import ICAPlotter
+
+            plotter = ICAPlotter._ICAPlotter(
+                experiment, cmap, n_components=ica_components,
+                incremental=svd_solver == 'incremental',
+                batch_size=batch_size
             )
-    elif algorithm == 'TSNE':
-        plotter = TSNEPlotter.tsneplot(
-            experiment,
-            cmap,
-            ax=ax, bokeh=False)
-        plotter.tcomp.to_csv(prefix + '.tsnecomp.txt', sep=SEP)
-    elif algorithm == 'ICA':
-        plotter = ICAPlotter.icaplot(
-            experiment,
-            cmap,
-            ax=ax, bokeh=False)
-        plotter.icacomp.to_csv(prefix + '.icacomp.txt', sep=SEP)
-        if keep_intermediates:
-            plotter.get_independent_components().to_csv(
-                prefix + '.icomp.txt', sep=SEP
+
+    with timer.stage(algorithm + ' plot'):
+        plotter.plot(bokeh=False, ax=ax, rasterized=rasterized)
+
+    with timer.stage(algorithm + ' save'):
+        if algorithm == 'PCA':
+            plotter.prcomp.to_csv(prefix + '.pcacomp.txt', sep=SEP)
+            if keep_intermediates:
+                plotter.get_pc_components(
+                    n_components=keep_components,
+                    n_features=keep_features
+                ).to_csv(
+                    prefix + '.prcomp.txt', sep=SEP
+                )
+        elif algorithm == 'TSNE':
+            plotter.tcomp.to_csv(prefix + '.tsnecomp.txt', sep=SEP)
+        elif algorithm == 'ICA':
+            plotter.icacomp.to_csv(prefix + '.icacomp.txt', sep=SEP)
+            if keep_intermediates:
+                plotter.get_independent_components(
+                    n_components=keep_components,
+                    n_features=keep_features
+                ).to_csv(
+                    prefix + '.icomp.txt', sep=SEP
+                )
+        if save_model:
+            if algorithm in projection.MODEL_ALGORITHMS:
+                mean, components = plotter.projection()
+                projection.fitted_model(
+                    algorithm, experiment.counts, mean, components,
+                    plotter.prcomp if algorithm == 'PCA' else plotter.icacomp
+                ).save(prefix + '.{}model.npz'.format(algorithm.lower()))
+            else:
+                print("warning, {} cannot place new samples, no model "
+                      "saved".format(algorithm))
+        if ax.get_legend_handles_labels()[0]:
+            leg = ax.legend(loc='best', shadow=False, frameon = 1)
+
+            leg.get_frame().set_edgecolor('b')
+            leg.get_frame().set_facecolor('w')
+        fig.savefig(output_file)
+    plt.close(fig)
+
+
+def project(experiment, model_file, output_file, cmap, rasterized=False,
+            timer=None):
+    """
+    Places the samples of experiment in the space of a saved PCA/ICA fit,
+    writing their coordinates to [prefix].projected.txt and plotting them
+    (over the fitted samples, in grey) to output_file.
+
+    Parameters
+    ----------
+    experiment : Experiment.Experiment
+        raw counts of the new samples
+    model_file : basestring
+        @see projection.ProjectionModel.save()
+    output_file : basestring
+    cmap : basestring or matplotlib.colors.Colormap
+    rasterized : Boolean
+    timer : stage_timer.StageTimer
+
+    Returns
+    -------
+
+    """
+    import matplotlib.pyplot as plt
+    from decomposition import matplotlib_helpers as mh
+
+    if timer is None:
+        timer = stage_timer.StageTimer()
+    prefix = os.path.splitext(output_file)[0]
+
+    with timer.stage('project'):
+        model = projection.load_model(model_file)
+        comp = model.transform(experiment.counts)
+
+    with timer.stage('project plot'):
+        fig, ax = plt.subplots()
+        if model.reference is not None:
+            ax.scatter(model.reference[0], model.reference[1],
+                       color='lightgrey', label=model.algorithm + ' fit',
+                       rasterized=rasterized)
+        metadata = experiment.metadata.reindex(comp.index)
+        mh.scatter(ax, comp, metadata['condition'],
+                   mh.metadata_to_rgba(metadata['color'], plt.get_cmap(cmap)),
+                   rasterized=rasterized)
+
+    with timer.stage('project save'):
+        comp.to_csv(prefix + '.projected.txt', sep=SEP)
+        if ax.get_legend_handles_labels()[0]:
+            leg = ax.legend(loc='best', shadow=False, frameon = 1)
+
+            leg.get_frame().set_edgecolor('b')
+            leg.get_frame().set_facecolor('w')
+        fig.savefig(output_file)
+    plt.close(fig)
+
+
+# shared with forked workers, so the experiment is never pickled.
+_SHARED = {}
+
+
+def _run_shared(algorithm, cmap, output_file, options):
+    timer = stage_timer.StageTimer()
+    run_algorithm(_SHARED['experiment'], algorithm, cmap, output_file,
+                  timer=timer, **options)
+    return algorithm, output_file, timer.stages
+
+
+def run_algorithms(experiment, algorithms, cmap, output_file, processes,
+                   logger, timer=None, **options):
+    """
+    Runs several algorithms on one (already normalized) experiment
+    concurrently in a pool of forked worker processes, writing each
+    figure to [prefix].[algorithm][ext] as soon as it completes. Runs them
+    one after the other where fork is not available. Each worker uses a
+    single BLAS/OpenMP thread. @see _fork_pool()
+
+    Parameters
+    ----------
+    experiment : Experiment.Experiment
+    algorithms : list
+        names from ALGORITHMS
+    cmap : basestring or matplotlib.colors.Colormap
+    output_file : basestring
+    processes : int
+        worker processes (one per algorithm if None)
+    logger : logging.Logger
+    timer : stage_timer.StageTimer
+        records the shared fit and each algorithm's stages (those timed in
+        worker processes are added as they complete)
+    options : dict
+        @see run_algorithm()
+
+    Returns
+    -------
+
+    """
+    prefix, ext = os.path.splitext(output_file)
+    outputs = [
+        "{}.{}{}".format(prefix, algorithm.lower(), ext)
+        for algorithm in algorithms
+    ]
+    if timer is None:
+        timer = stage_timer.StageTimer()
+    # load, normalize and fit the shared PCA once, before forking
+    with timer.stage('shared PCA fit'):
+        if 'PCA' in algorithms:
+            experiment.pca(
+                options.get('n_components'),
+                options.get('svd_solver'),
+                options.get('batch_size')
             )
-    else:
-        print("invalid algorithm. Exiting..")
-        sys.exit(1)
-    leg = plt.legend(loc='best', shadow=False, frameon = 1)
+        incremental = options.get('svd_solver') == 'incremental'
+        if 'ICA' in algorithms:
+            experiment.pca(*cph.ica_pca_params(
+                experiment.counts.is_sparse, options.get('ica_components'),
+                incremental
+            ), batch_size=options.get('batch_size'))
+        if 'TSNE' in algorithms:
+            experiment.pca(
+                None, 'incremental' if incremental else None,
+                options.get('batch_size')
+            )
+
+    # set before forking so workers inherit it
+    _SHARED['experiment'] = experiment
+    pool = _fork_pool(processes or len(algorithms))
+    if pool is None:
+        _SHARED.pop('experiment')
+        for algorithm, output in zip(algorithms, outputs):
+            run_algorithm(experiment, algorithm, cmap, output, timer=timer,
+                          **options)
+            logger.info("{} DONE: {}".format(algorithm, output))
+        return
+
+    def done(result):
+        algorithm, output, stages = result
+        for stage in stages:
+            timer.add(stage)
+        logger.info("{} DONE: {}".format(algorithm, output))
+
+    try:
+        results = [
+            pool.apply_async(
+                _run_shared,
+                (algorithm, cmap, output, options),
+                callback=done
+            )
+            for algorithm, output in zip(algorithms, outputs)
+        ]
+        pool.close()
+        for result in results:
+            result.get()  # re-raises any worker error
+        pool.join()
+    finally:
+        pool.terminate()
+        _SHARED.pop('experiment')
+
+
+def _fork_pool(processes):
+    """
+    a multiprocessing.Pool of forked workers, or None if unsupported.
+    The workers inherit the parent's loaded (and fitted) experiment, so
+    they must be forked rather than spawned, but the parent has usually
+    run BLAS/OpenMP code by then, and an OpenMP thread pool does not
+    survive a fork (the child can hang on its first parallel region).
+    Workers are therefore limited to one BLAS/OpenMP thread each, which
+    also keeps concurrent workers from oversubscribing the cpus.
+    @see _single_threaded()
+    """
+    if not hasattr(os, 'fork'):
+        return None
+    if multiprocessing.current_process().daemon:
+        # pool workers (ie. batch jobs) cannot have children of their own
+        return None
+    try:
+        context = multiprocessing.get_context('fork')
+    except AttributeError:
+        # python 2 always forks
+        context = multiprocessing
+    return context.Pool(processes, initializer=_single_threaded)
+
+
+def _single_threaded():
+    """
+    Pool initializer limiting BLAS and OpenMP to one thread in a forked
+    worker (threadpoolctl is installed with scikit-learn), and through
+    the environment for anything that starts a thread pool later.
+    """
+    for name in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                 'MKL_NUM_THREADS'):
+        os.environ[name] = '1'
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        print("warning, threadpoolctl is not installed, workers may use "
+              "several BLAS threads after fork")
+        return
+    # applied on construction, for the life of the worker
+    threadpool_limits(limits=1)
+
+
+def batch(argv):
+    """
+    Runs every job listed in a manifest (decompose batch manifest.tsv).
+    Jobs are grouped by input: each input matrix is parsed once in the
+    parent, its jobs run in a pool of forked worker processes (sharing the
+    parsed table, copied only by jobs that transform it), and it is
+    dropped before the next input is read, so only one input is held at a
+    time. Each job logs to its own [prefix].log and [prefix].err. A failed
+    job does not stop the others.
+
+    Parameters
+    ----------
+    argv : list
+        command line arguments following 'batch'
+
+    Returns
+    -------
+    int : 0 if every job succeeded, 1 otherwise
+    """
+    parser = ArgumentParser(
+        prog='decompose batch',
+        description="runs each row of a tab separated manifest with the "
+                    "header: {}".format(' '.join(MANIFEST_COLUMNS))
+    )
+    parser.add_argument("manifest", help="manifest file")
+    parser.add_argument("-p", "--processes",
+                        dest="processes",
+                        help="worker processes (default: number of cpus)",
+                        type=int,
+                        default=None)
+    batch_args = parser.parse_args(argv)
+
+    processes = batch_args.processes or multiprocessing.cpu_count()
+
+    # one parse per distinct input (and reader options), in manifest order
+    groups = {}
+    keys = []
+    for key, args in read_manifest(batch_args.manifest):
+        if key not in groups:
+            groups[key] = []
+            keys.append(key)
+        groups[key].append(args)
+
+    failed = 0
+    for key in keys:
+        group = groups.pop(key)
+        args = group[0]
+        print("loading {}".format(args.input))
+        cache_dir, mmap_dir = reader_dirs(args)
+        _SHARED['table'] = Experiment.load_counts(
+            args.input,
+            is_featurecounts=args.featureCounts,
+            row_names_file=args.row_names,
+            col_names_file=args.col_names,
+            cache_dir=cache_dir,
+            chunksize=args.chunksize,
+            dtype=args.dtype,
+            mmap=args.incremental,
+            mmap_dir=mmap_dir,
+            lengths_file=args.lengths
+        )
+        pool = _fork_pool(min(processes, len(group)))
+        try:
+            if pool is None:
+                results = [_run_job(args) for args in group]
+            else:
+                pending = [
+                    pool.apply_async(_run_job, (args,)) for args in group
+                ]
+                pool.close()
+                results = [result.get() for result in pending]
+                pool.join()
+        finally:
+            if pool is not None:
+                pool.terminate()
+            # drop the table before reading the next input
+            _SHARED.clear()
+        for output, error in results:
+            if error is None:
+                print("DONE: {}".format(output))
+            else:
+                failed += 1
+                print("FAILED: {} ({})".format(output, error))
+
+    return 1 if failed else 0
+
+
+def read_manifest(manifest):
+    """
+    Parses a batch manifest. Each row names an input, an (optional)
+    conditions file and column, the algorithm(s) and the output file, plus
+    any other decompose flags as one shell-quoted string. Lines starting
+    with '#' are ignored.
+
+    Parameters
+    ----------
+    manifest : basestring
+        tab separated file with the header MANIFEST_COLUMNS
+
+    Returns
+    -------
+    list of (tuple, argparse.Namespace)
+        the key of the input table each job reads, and its arguments
+    """
+    parser = build_parser()
+    jobs = []
+    with open(manifest) as f:
+        rows = csv.DictReader(
+            (line for line in f if not line.startswith('#')),
+            delimiter='\t'
+        )
+        for row in rows:
+            argv = ['-i', row['input'], '-o', row['output']]
+            if row.get('conditions'):
+                argv += ['-c', row['conditions']]
+            if row.get('conditions_col'):
+                argv += ['-cc', row['conditions_col']]
+            if row.get('algorithm'):
+                argv += ['-a', row['algorithm']]
+            argv += shlex.split(row.get('flags') or '')
+            args = parser.parse_args(argv)
+            if parse_algorithms(args.algorithm) is None:
+                parser.error(
+                    "invalid algorithm: {}".format(args.algorithm)
+                )
+            check_args(parser, args)
+            key = (
+                os.path.abspath(args.input), args.featureCounts,
+                args.row_names, args.col_names, args.chunksize, args.dtype,
+                None if args.no_cache else args.cache_dir, args.incremental,
+                args.mmap_dir, args.lengths
+            )
+            jobs.append((key, args))
+    return jobs
+
+
+def transforms_table(args):
+    """
+    True if a run with args changes its input table (subset, rpkm, cutoff,
+    log2 or top variable genes), ie. a shared table must be copied first.
+    Projections normalize a copy of the values themselves.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        @see build_parser()
+
+    Returns
+    -------
+    Boolean
+    """
+    if args.project_onto is not None:
+        return False
+    return bool(
+        (args.subset and os.path.exists(args.subset)) or args.rpkm or
+        args.cutoff > 0 or args.log2 or args.top_variable is not None
+    )
 
-    leg.get_frame().set_edgecolor('b')
-    leg.get_frame().set_facecolor('w')
-    fig.savefig(output_file)
 
+def _run_job(args):
+    """
+    runs one batch job on the shared input table, or on a copy of it if
+    the job transforms it. Untouched, a forked worker's table stays
+    shared with the parent's pages. @see transforms_table()
+    """
+    prefix = os.path.splitext(args.output)[0]
+    logger = setup_logger('PCA_runner.{}'.format(prefix), prefix)
+    try:
+        logger.info("starting batch job")
+        logger.info(vars(args))
+        counts = _SHARED['table']
+        if transforms_table(args):
+            counts = counts.copy()
+        run(args, logger, counts=counts)
+        return args.output, None
+    except Exception as e:
+        logger.exception("batch job failed")
+        return args.output, "{}: {}".format(type(e).__name__, e)
+    finally:
+        close_logger(logger)
 
 
 if __name__ == "__main__":
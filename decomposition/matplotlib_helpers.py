@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+from matplotlib.colors import to_rgba_array
+
+import color_helpers as ch
+
+# conditions from which the legend is left out (ie. one per cell barcode).
+LEGEND_MAX_CONDITIONS = 50
+
+
+def metadata_to_rgba(colors, cmap):
+    """
+    Returns the color of every sample. Numeric metadata colors (condition
+    numbers or expression) are scaled to a max of 1 through cmap, anything
+    else is taken as a matplotlib color name (ie. the 'blue' of metadata
+    generated without conditions or genes).
+
+    Parameters
+    ----------
+    colors : pandas.Series
+        metadata 'color' column
+    cmap : matplotlib.colors.Colormap
+
+    Returns
+    -------
+    numpy.ndarray of (N, 4) rgba
+    """
+    values = pd.to_numeric(colors, errors='coerce')
+    if values.notnull().sum() == colors.notnull().sum():
+        return ch.expr_to_rgb(values, cmap, is_norm=True)
+    return to_rgba_array(list(colors.fillna('none')))
+
+
+def scatter(ax, comp, conditions, rgba, rasterized=False):
+    """
+    Draws every sample with one scatter call, and adds one (empty) legend
+    entry per condition in the color of its first sample.
+
+    Parameters
+    ----------
+    ax : matplotlib.axes._subplots.AxesSubplot
+    comp : pandas.DataFrame
+        (samples, components) coordinates, the first two are plotted
+    conditions : pandas.Series
+        condition of every sample in comp (samples without one are skipped)
+    rgba : numpy.ndarray
+        (N, 4) color of every sample in comp
+    rasterized : Boolean
+        draw the points as one image in vector (pdf, svg) output
+
+    Returns
+    -------
+
+    """
+    keep = conditions.notnull().values
+    rgba = np.asarray(rgba)[keep]
+    ax.scatter(comp.values[keep, 0], comp.values[keep, 1],
+               color=rgba, rasterized=rasterized)
+
+    codes, labels = pd.factorize(conditions[keep])
+    if len(labels) > LEGEND_MAX_CONDITIONS:
+        return
+    _, first = np.unique(codes, return_index=True)
+    for label, i in zip(labels, first):
+        ax.scatter([], [], color=rgba[i], label=label)
@@ -0,0 +1,247 @@
+import numpy as np
+import pandas as pd
+
+# algorithms whose fit is a linear map of the (normalized) expression, so
+# new samples can be placed without refitting (t-SNE has no such map).
+MODEL_ALGORITHMS = ('PCA', 'ICA')
+
+
+def row_positions(index, genes):
+    """
+    Returns the row of each of genes in index (the first one for duplicate
+    ids), or -1 for genes index does not contain. Ids are compared as
+    strings, as they are saved.
+
+    Parameters
+    ----------
+    index : pandas.Index
+    genes : list-like
+
+    Returns
+    -------
+    numpy.ndarray of int
+    """
+    rows = pd.Series(np.arange(len(index)), index=_strings(index))
+    rows = rows[~rows.index.duplicated()]
+    return rows.reindex(_strings(genes)).fillna(-1).values.astype(np.int64)
+
+
+def take_expression(counts, positions):
+    """
+    Returns the rows of an expression table at positions as a dense
+    float64 (genes, samples) array, with zeros for positions of -1.
+
+    Parameters
+    ----------
+    counts : ExpressionTable.ExpressionTable
+    positions : numpy.ndarray
+        @see row_positions()
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    found = positions >= 0
+    values = np.zeros((len(positions), counts.shape[1]), dtype=np.float64)
+    if counts.is_sparse:
+        values[found] = counts.data[positions[found]].toarray()
+    else:
+        values[found] = counts.data.values[positions[found]]
+    return values
+
+
+class ProjectionModel(object):
+    """
+    A fitted PCA or ICA kept as the linear map it applies to normalized
+    expression, along with how that expression was normalized (gene
+    order, RPKM lengths and mapped-read genes, log2 pseudocount). New raw
+    counts are normalized the same way and placed in the fitted space with
+    one matrix multiply, instead of refitting the whole cohort.
+    """
+    def __init__(self, algorithm, genes, mean, components, rpkm=False,
+                 rpkm_genes=None, lengths=None, log2=False, pseudocount=0,
+                 reference=None):
+        """
+
+        Parameters
+        ----------
+        algorithm : basestring
+            one of MODEL_ALGORITHMS
+        genes : list-like
+            features of the fit, in the order of the components' columns
+        mean : numpy.ndarray
+            (features,) subtracted before projecting
+        components : numpy.ndarray
+            (components, features)
+        rpkm : Boolean
+            True if the fit was on RPKM
+        rpkm_genes : list-like
+            genes whose counts made up each sample's mapped reads
+        lengths : numpy.ndarray
+            (features,) gene lengths, if rpkm
+        log2 : Boolean
+            True if the fit was on log2(x + pseudocount)
+        pseudocount : float
+        reference : pandas.DataFrame
+            (samples, 2) coordinates of the fitted samples, drawn behind
+            projected ones (optional)
+        """
+        self.algorithm = algorithm
+        self.genes = pd.Index(genes)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.components = np.asarray(components, dtype=np.float64)
+        self.rpkm = bool(rpkm)
+        self.rpkm_genes = None if rpkm_genes is None else pd.Index(rpkm_genes)
+        self.lengths = None if lengths is None else np.asarray(
+            lengths, dtype=np.float64
+        )
+        self.log2 = bool(log2)
+        self.pseudocount = pseudocount
+        self.reference = reference
+
+    def save(self, path):
+        """
+        Writes the model to path as a compressed numpy .npz (which loads
+        without unpickling anything). @see load_model()
+
+        Parameters
+        ----------
+        path : basestring
+        """
+        arrays = dict(
+            algorithm=np.array(self.algorithm),
+            genes=_strings(self.genes),
+            mean=self.mean,
+            components=self.components,
+            rpkm=np.array(self.rpkm),
+            log2=np.array(self.log2),
+            pseudocount=np.array(self.pseudocount, dtype=np.float64),
+        )
+        if self.rpkm:
+            arrays['rpkm_genes'] = _strings(self.rpkm_genes)
+            arrays['lengths'] = self.lengths
+        if self.reference is not None:
+            arrays['reference'] = self.reference.values[:, :2]
+            arrays['reference_samples'] = _strings(self.reference.index)
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+
+    def normalize(self, counts):
+        """
+        Applies the fit's normalization to raw counts: model genes the
+        input does not have are counted as 0, RPKM mapped reads are summed
+        over the same genes as in the fit.
+
+        Parameters
+        ----------
+        counts : ExpressionTable.ExpressionTable
+            raw counts of the new samples
+
+        Returns
+        -------
+        numpy.ndarray
+            (features, samples) float64 values
+        """
+        positions = row_positions(counts.index, self.genes)
+        missing = (positions < 0).sum()
+        if missing:
+            print("warning, {} of {} model genes not in the input, "
+                  "counted as 0".format(missing, len(self.genes)))
+        values = take_expression(counts, positions)
+        if self.rpkm:
+            mapped_reads = take_expression(
+                counts, row_positions(counts.index, self.rpkm_genes)
+            ).sum(axis=0)
+            values *= pow(10, 9) / mapped_reads
+            values /= self.lengths[:, np.newaxis]
+        if self.log2:
+            values += self.pseudocount
+            np.log2(values, out=values)
+        return values
+
+    def transform(self, counts):
+        """
+        Places the samples of counts in the fitted space.
+
+        Parameters
+        ----------
+        counts : ExpressionTable.ExpressionTable
+            raw counts of the new samples (@see normalize())
+
+        Returns
+        -------
+        pandas.DataFrame
+            (samples, components) coordinates
+        """
+        values = self.normalize(counts)
+        # (X - mean) C' as one product, the mean folded into a shift
+        scores = np.dot(values.T, self.components.T)
+        scores -= np.dot(self.mean, self.components.T)
+        return pd.DataFrame(scores, index=counts.columns)
+
+
+def fitted_model(algorithm, counts, mean, components, scores=None):
+    """
+    Returns the ProjectionModel of a fit on the (normalized) counts.
+
+    Parameters
+    ----------
+    algorithm : basestring
+        one of MODEL_ALGORITHMS
+    counts : ExpressionTable.ExpressionTable
+        the table the fit was made on
+    mean : numpy.ndarray
+    components : numpy.ndarray
+        @see _PCAPlotter.projection(), _ICAPlotter.projection()
+    scores : pandas.DataFrame
+        (samples, components) coordinates of the fitted samples
+
+    Returns
+    -------
+    ProjectionModel
+    """
+    if algorithm not in MODEL_ALGORITHMS:
+        raise ValueError(
+            "{} has no linear map to save as a model".format(algorithm)
+        )
+    return ProjectionModel(
+        algorithm, counts.index, mean, components, reference=scores,
+        **counts.normalization()
+    )
+
+
+def load_model(path):
+    """
+    Reads a model written by ProjectionModel.save().
+
+    Parameters
+    ----------
+    path : basestring
+
+    Returns
+    -------
+    ProjectionModel
+    """
+    with np.load(path, allow_pickle=False) as arrays:
+        reference = None
+        if 'reference' in arrays:
+            reference = pd.DataFrame(
+                arrays['reference'], index=arrays['reference_samples']
+            )
+        rpkm = bool(arrays['rpkm'])
+        return ProjectionModel(
+            str(arrays['algorithm']),
+            arrays['genes'],
+            arrays['mean'],
+            arrays['components'],
+            rpkm=rpkm,
+            rpkm_genes=arrays['rpkm_genes'] if rpkm else None,
+            lengths=arrays['lengths'] if rpkm else None,
+            log2=bool(arrays['log2']),
+            pseudocount=float(arrays['pseudocount']),
+            reference=reference
+        )
+
+
+def _strings(index):
+    return np.array([str(name) for name in index])
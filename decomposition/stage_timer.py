@@ -0,0 +1,128 @@
+import contextlib
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+def peak_rss_mb(who='self'):
+    """
+    Returns the peak resident set size so far of this process ('self') or
+    of its largest waited-for child process ('children'), in MB.
+
+    Parameters
+    ----------
+    who : basestring
+
+    Returns
+    -------
+    float or None
+        None where the resource module is not available
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(
+        resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN
+    )
+    # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return usage.ru_maxrss / float(scale)
+
+
+def cpu_seconds():
+    """ user + system time of this process and its waited-for children """
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+class StageTimer(object):
+    """
+    Records the wall time, CPU time and peak RSS of each stage of a run,
+    logs each stage as it ends and writes them all as a JSON report.
+    Peak RSS is the high-water mark of the process at the end of the
+    stage, so a stage that raised it is the first one reporting the new
+    value.
+    """
+    def __init__(self, logger=None):
+        """
+
+        Parameters
+        ----------
+        logger : logging.Logger
+            stages are logged at INFO level (not logged if None)
+
+        Attributes
+        ----------
+        self.stages : list
+            one dict per finished stage, in order
+        self.start : float
+            time the timer was created
+        """
+        self.logger = logger
+        self.stages = []
+        self.start = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Times the enclosed block as the stage name.
+
+        Parameters
+        ----------
+        name : basestring
+        """
+        wall = time.time()
+        cpu = cpu_seconds()
+        yield
+        self.add({
+            'stage': name,
+            'wall_seconds': time.time() - wall,
+            'cpu_seconds': cpu_seconds() - cpu,
+            'peak_rss_mb': peak_rss_mb('self'),
+            'children_peak_rss_mb': peak_rss_mb('children'),
+        })
+
+    def add(self, stage):
+        """
+        Records (and logs) a finished stage, ie. one timed in a worker
+        process.
+
+        Parameters
+        ----------
+        stage : dict
+            @see stage()
+        """
+        self.stages.append(stage)
+        if self.logger is not None:
+            self.logger.info(
+                "STAGE {}: wall {:.3f}s, cpu {:.3f}s, peak rss {} MB".format(
+                    stage['stage'], stage['wall_seconds'],
+                    stage['cpu_seconds'], _format_mb(stage['peak_rss_mb'])
+                )
+            )
+
+    def report(self, path, **info):
+        """
+        Writes the recorded stages to path as JSON.
+
+        Parameters
+        ----------
+        path : basestring
+        info : dict
+            extra fields describing the run (ie. input, shape)
+        """
+        report = dict(info)
+        report['stages'] = self.stages
+        # stages timed in worker processes overlap, so they are not summed
+        report['elapsed_wall_seconds'] = time.time() - self.start
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+def _format_mb(mb):
+    return 'n/a' if mb is None else '{:.1f}'.format(mb)
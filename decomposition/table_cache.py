@@ -0,0 +1,360 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+# bump whenever the on-disk layout or the parsers change what they return.
+CACHE_VERSION = 3
+# total size of the entries in a cache directory, beyond which the least
+# recently used ones are removed.
+CACHE_MAX_BYTES = 20 * pow(2, 30)
+
+
+def default_cache_dir():
+    """
+    Returns the cache directory used by the decompose command line:
+    $DECOMPOSITION_CACHE_DIR, or None (no caching) if it is not set.
+
+    Returns
+    -------
+    basestring
+    """
+    return os.environ.get('DECOMPOSITION_CACHE_DIR')
+
+
+def cache_entry(cache_dir, data_file, kind):
+    """
+    Returns the directory holding the cached parse of data_file. The key
+    covers the absolute path, modification time and size of the input, so
+    any change to the file invalidates its entry.
+
+    Parameters
+    ----------
+    cache_dir : basestring
+    data_file : basestring
+        the text file that was parsed
+    kind : basestring
+        distinguishes parsers of the same file (ie. 'table' vs
+        'featurecounts')
+
+    Returns
+    -------
+    basestring
+    """
+    path = os.path.abspath(data_file)
+    stat = os.stat(path)
+    key = '{}|{}|{}|{}|{}'.format(
+        path, repr(stat.st_mtime), stat.st_size, kind, CACHE_VERSION
+    )
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(
+        cache_dir, '{}.{}'.format(os.path.basename(path), digest[:16])
+    )
+
+
+def load_chunks(cache_dir, data_file, kind, chunksize):
+    """
+    Returns a generator over a previously stored parse of data_file,
+    chunksize rows at a time. Values are memory-mapped, so only the chunk
+    being handed out is paged in.
+
+    Parameters
+    ----------
+    cache_dir : basestring
+    data_file : basestring
+    kind : basestring
+    chunksize : int
+
+    Returns
+    -------
+    generator of (pandas.DataFrame, pandas.Series or None), or None if
+    there is no valid cache entry.
+    """
+    entry = cache_entry(cache_dir, data_file, kind)
+    if not os.path.isdir(entry):
+        return None
+    _touch(entry)
+    return _iter_entry(entry, chunksize)
+
+
+def load_values(cache_dir, data_file, kind):
+    """
+    Returns a previously stored parse of data_file with the values
+    memory-mapped (read only) rather than read into memory, so they are
+    paged in on use and shared through the page cache between processes.
+    Values are stored sample-major (Fortran order), so each sample's
+    column, and a batch of consecutive samples, is one contiguous span.
+
+    Parameters
+    ----------
+    cache_dir : basestring
+    data_file : basestring
+    kind : basestring
+
+    Returns
+    -------
+    (numpy.memmap, pandas.Index, pandas.Index, pandas.Series or None)
+        values, row and column labels and lengths, or None if there is no
+        valid cache entry.
+    """
+    entry = cache_entry(cache_dir, data_file, kind)
+    if not os.path.isdir(entry):
+        return None
+    _touch(entry)
+    return _read_entry(entry)
+
+
+def _read_entry(entry):
+    with open(os.path.join(entry, 'meta.json')) as f:
+        meta = json.load(f)
+    index = pd.Index(
+        np.load(os.path.join(entry, 'index.npy')), name=meta['index_name']
+    )
+    columns = pd.Index(
+        np.load(os.path.join(entry, 'columns.npy')),
+        name=meta['columns_name']
+    )
+    values = np.load(os.path.join(entry, 'values.npy'), mmap_mode='r')
+    length = None
+    if meta['has_length']:
+        length = pd.Series(
+            np.load(os.path.join(entry, 'length.npy')),
+            index=index,
+            name=meta['length_name']
+        )
+    return values, index, columns, length
+
+
+def _iter_entry(entry, chunksize):
+    values, index, columns, length = _read_entry(entry)
+    for start in range(0, max(len(index), 1), chunksize):
+        stop = start + chunksize
+        data = pd.DataFrame(
+            np.array(values[start:stop]),
+            index=index[start:stop],
+            columns=columns
+        )
+        if length is None:
+            yield data, None
+        else:
+            yield data, length.iloc[start:stop]
+
+
+def store_chunks(cache_dir, data_file, kind, chunks,
+                 max_bytes=CACHE_MAX_BYTES, errors=None):
+    """
+    Passes parsed chunks through unchanged while storing them as .npy
+    arrays (values, row and column labels, and optionally gene lengths),
+    so later runs can skip parsing the text. Chunks are spilled to disk as
+    they arrive and assembled into one entry once the last chunk has been
+    seen; the entry is renamed into place, so concurrent runs never see a
+    partial entry. Failing to write the cache only prints a warning.
+
+    Tables mixing integer and float columns are not stored, as one .npy
+    array would give every column the same dtype. Once stored, entries of
+    earlier versions of data_file (parsed the same kind) are removed,
+    then the least recently used entries until the cache is no larger
+    than max_bytes. @see evict()
+
+    Parameters
+    ----------
+    cache_dir : basestring
+    data_file : basestring
+    kind : basestring
+    chunks : iterable
+        (pandas.DataFrame, pandas.Series or None) data and lengths
+    max_bytes : int
+    errors : list
+        if given, the reason data_file is not stored is appended to it as
+        soon as it is known, ie. before the chunk that failed is passed on
+
+    Returns
+    -------
+    generator of (pandas.DataFrame, pandas.Series or None)
+    """
+    entry = cache_entry(cache_dir, data_file, kind)
+    tmp = None
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp = tempfile.mkdtemp(dir=cache_dir)
+    except (IOError, OSError) as e:
+        print("warning, could not cache {}: {}".format(data_file, e))
+        if errors is not None:
+            errors.append(e)
+
+    parts = []
+    indices = []
+    lengths = []
+    try:
+        for data, length in chunks:
+            if tmp is not None:
+                try:
+                    if data.values.dtype == object:
+                        raise ValueError("non-numeric values")
+                    if data.dtypes.nunique() > 1:
+                        raise ValueError(
+                            "columns of different dtypes would be stored "
+                            "as {}".format(data.values.dtype)
+                        )
+                    part = os.path.join(tmp, 'part{}.npy'.format(len(parts)))
+                    np.save(part, data.values)
+                    parts.append(part)
+                    indices.append(data.index)
+                    lengths.append(length)
+                    columns = data.columns
+                except (IOError, OSError, ValueError) as e:
+                    print("warning, could not cache {}: {}".format(
+                        data_file, e
+                    ))
+                    if errors is not None:
+                        errors.append(e)
+                    shutil.rmtree(tmp)
+                    tmp = None
+            yield data, length
+
+        if tmp is not None and parts:
+            try:
+                _assemble(tmp, parts, indices, lengths, columns,
+                          os.path.abspath(data_file), kind)
+                os.rename(tmp, entry)
+            except (IOError, OSError) as e:
+                # another run may have stored the same entry first
+                if not os.path.isdir(entry):
+                    print("warning, could not cache {}: {}".format(
+                        data_file, e
+                    ))
+                    if errors is not None:
+                        errors.append(e)
+            evict(cache_dir, max_bytes, keep=entry)
+    finally:
+        if tmp is not None and os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+
+
+def evict(cache_dir, max_bytes=CACHE_MAX_BYTES, keep=None):
+    """
+    Removes the entries of inputs that have changed since they were
+    cached (other entries of the same path and kind as keep; entries of
+    other kinds, ie. another dtype, are still valid), then the least
+    recently used entries until the total size is at most max_bytes.
+    Entries being written by another run are left alone.
+
+    Parameters
+    ----------
+    cache_dir : basestring
+    max_bytes : int
+    keep : basestring
+        entry that was just stored (never removed)
+    """
+    keep_source = _entry_source(keep) if keep is not None else None
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if entry == keep or not os.path.isfile(
+                os.path.join(entry, 'meta.json')):
+            continue
+        if keep_source is not None and _same_source(
+                _entry_source(entry), keep_source):
+            shutil.rmtree(entry, ignore_errors=True)
+            continue
+        entries.append((os.path.getmtime(entry), _size(entry), entry))
+
+    total = sum(size for _, size, _ in entries)
+    if keep is not None and os.path.isdir(keep):
+        total += _size(keep)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+def _entry_source(entry):
+    """ the input file an entry was parsed from, and the kind of parse """
+    try:
+        with open(os.path.join(entry, 'meta.json')) as f:
+            meta = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None, None
+    return meta.get('path'), meta.get('kind')
+
+
+def _same_source(source, other):
+    """
+    True if both entries are parses of one path of the same kind. Entries
+    stored before kinds were recorded match any kind of their path.
+    """
+    path, kind = source
+    if path is None or path != other[0]:
+        return False
+    return kind is None or kind == other[1]
+
+
+def _size(entry):
+    return sum(
+        os.path.getsize(os.path.join(entry, name))
+        for name in os.listdir(entry)
+    )
+
+
+def _touch(entry):
+    """ marks an entry as used, for evict() """
+    try:
+        now = time.time()
+        os.utime(entry, (now, now))
+    except OSError:
+        pass
+
+
+def _assemble(tmp, parts, indices, lengths, columns, path, kind):
+    """ concatenates spilled chunks into the files of one cache entry """
+    arrays = [np.load(part, mmap_mode='r') for part in parts]
+    n_rows = sum(a.shape[0] for a in arrays)
+    values = np.lib.format.open_memmap(
+        os.path.join(tmp, 'values.npy'),
+        mode='w+',
+        dtype=np.result_type(*arrays),
+        shape=(n_rows, len(columns)),
+        fortran_order=True
+    )
+    start = 0
+    for a in arrays:
+        values[start:start + a.shape[0]] = a
+        start += a.shape[0]
+    values.flush()
+    del values, arrays
+    for part in parts:
+        os.remove(part)
+
+    index = indices[0].append(indices[1:]) if len(indices) > 1 else indices[0]
+    np.save(os.path.join(tmp, 'index.npy'), _labels(index))
+    np.save(os.path.join(tmp, 'columns.npy'), _labels(columns))
+    has_length = lengths[0] is not None
+    if has_length:
+        np.save(
+            os.path.join(tmp, 'length.npy'),
+            np.concatenate([length.values for length in lengths])
+        )
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump({
+            'path': path,
+            'kind': kind,
+            'index_name': index.name,
+            'columns_name': columns.name,
+            'has_length': has_length,
+            'length_name': lengths[0].name if has_length else None,
+        }, f)
+
+
+def _labels(index):
+    """ numpy array of index labels that can be saved without pickling """
+    values = np.asarray(index)
+    if values.dtype == object:
+        values = values.astype(np.str_)
+    return values
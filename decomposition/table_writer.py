@@ -0,0 +1,208 @@
+import gzip
+import threading
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+FORMATS = ('txt', 'txt.gz', 'npy', 'parquet')
+# bytes of table copies queued or being written before write() blocks
+# (one copy is always allowed, however large).
+MAX_PENDING_BYTES = pow(2, 30)
+
+
+def write_table(table, prefix, fmt='txt', float_precision=None, sep='\t'):
+    """
+    Writes an expression table to [prefix].[fmt].
+
+    txt and txt.gz are delimited text. npy writes the values (a scipy
+    .npz for sparse tables) next to [prefix].rows.txt and
+    [prefix].cols.txt, which reads back with --row-names/--col-names.
+    parquet needs pyarrow or fastparquet and a dense table.
+
+    Parameters
+    ----------
+    table : ExpressionTable.ExpressionTable
+    prefix : basestring
+    fmt : basestring
+        one of FORMATS
+    float_precision : int
+        significant digits of floats in text formats (all if None)
+    sep : basestring
+
+    Returns
+    -------
+    basestring
+        the path written
+    """
+    if fmt in ('txt', 'txt.gz'):
+        path = '{}.{}'.format(prefix, fmt)
+        float_format = None
+        if float_precision is not None:
+            float_format = '%.{}g'.format(float_precision)
+        if fmt == 'txt.gz':
+            with gzip.open(path, 'wt') as f:
+                table.to_csv(f, sep=sep, float_format=float_format)
+        else:
+            table.to_csv(path, sep=sep, float_format=float_format)
+    elif fmt == 'npy':
+        if table.is_sparse:
+            path = prefix + '.npz'
+            sparse.save_npz(path, sparse.csr_matrix(table.data))
+        else:
+            path = prefix + '.npy'
+            np.save(path, table.data.values)
+        _write_names(prefix + '.rows.txt', table.index)
+        _write_names(prefix + '.cols.txt', table.columns)
+    elif fmt == 'parquet':
+        if table.is_sparse:
+            raise ValueError("parquet output needs a dense table")
+        path = prefix + '.parquet'
+        pd.DataFrame(
+            table.data.values,
+            index=table.index,
+            columns=[str(c) for c in table.columns],
+            copy=False
+        ).to_parquet(path)
+    else:
+        raise ValueError("unknown intermediates format: {}".format(fmt))
+    return path
+
+
+def table_nbytes(table):
+    """
+    Returns the size of the values of an expression table.
+
+    Parameters
+    ----------
+    table : ExpressionTable.ExpressionTable
+
+    Returns
+    -------
+    int
+    """
+    data = table.data
+    if table.is_sparse:
+        return data.data.nbytes + data.indices.nbytes + data.indptr.nbytes
+    return data.values.nbytes
+
+
+def _write_names(path, index):
+    with open(path, 'w') as f:
+        for name in index:
+            f.write('{}\n'.format(name))
+
+
+class IntermediateWriter(object):
+    """
+    Writes intermediate tables on a background thread, so the pipeline
+    does not wait on the disk. Each table is copied when queued (later
+    steps transform values in place), and write() blocks while the copies
+    not yet written would take more than max_pending_bytes. At most one
+    copy is held for tables larger than that, so the peak is the table
+    plus one copy of it. Copies go to the table's mmap_dir if it has
+    one (@see ExpressionTable.allocate()). @see write_table()
+    """
+    def __init__(self, fmt='txt', float_precision=None, sep='\t',
+                 max_pending_bytes=MAX_PENDING_BYTES):
+        """
+
+        Parameters
+        ----------
+        fmt : basestring
+            one of FORMATS
+        float_precision : int
+            significant digits of floats in text formats (all if None)
+        sep : basestring
+        max_pending_bytes : int
+            size of the copies queued or being written beyond which
+            write() waits for them (@see table_nbytes())
+        """
+        if fmt not in FORMATS:
+            raise ValueError("unknown intermediates format: {}".format(fmt))
+        if fmt == 'parquet':
+            _check_parquet()
+        self.fmt = fmt
+        self.float_precision = float_precision
+        self.sep = sep
+        self.max_pending_bytes = max_pending_bytes
+        self.written = []
+        self._error = None
+        self._pending_bytes = 0
+        self._written_one = threading.Condition()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, table, prefix):
+        """
+        Queues a snapshot of table to be written to [prefix].[fmt].
+
+        Parameters
+        ----------
+        table : ExpressionTable.ExpressionTable
+        prefix : basestring
+        """
+        nbytes = table_nbytes(table)
+        with self._written_one:
+            while (self._pending_bytes and self._pending_bytes + nbytes >
+                   self.max_pending_bytes):
+                self._written_one.wait()
+            self._pending_bytes += nbytes
+        snapshot = table.copy()
+        snapshot.data  # run any pending operations on the copy
+        self._queue.put((snapshot, prefix, nbytes))
+
+    def close(self):
+        """
+        Waits for the queued tables to be written, and raises the first
+        error met while writing them.
+
+        Returns
+        -------
+        list of basestring
+            the paths written
+        """
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self.written
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            table, prefix, nbytes = item
+            item = None
+            if self._error is None:
+                try:
+                    self.written.append(write_table(
+                        table, prefix, self.fmt, self.float_precision,
+                        self.sep
+                    ))
+                except Exception as e:
+                    self._error = e
+            table = None  # free the copy before making room for another
+            with self._written_one:
+                self._pending_bytes -= nbytes
+                self._written_one.notify_all()
+
+
+def _check_parquet():
+    try:
+        import pyarrow
+    except ImportError:
+        try:
+            import fastparquet
+        except ImportError:
+            raise ValueError(
+                "parquet intermediates require pyarrow or fastparquet"
+            )
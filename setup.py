@@ -31,6 +31,7 @@ setup(
     install_requires=[
         'numpy>=1.10',
         'pandas>=0.16',
+        'scipy>=0.19',
         'matplotlib>=1.5',
         'sklearn',
         'seaborn>=0.7',